@@ -9,7 +9,8 @@ import math
 from zipline.algorithm import TradingAlgorithm
 from zipline.protocol import DATASOURCE_TYPE
 from zipline.finance.blotter import ORDER_STATUS
-from zipline.utils.tradingcalendar import get_trading_days
+
+from pulley.calendar import date_utils
 
 # Order types for each event, keys for event_orders
 ENTRY = 'ENTRY'
@@ -245,10 +246,10 @@ class EventTrader(TradingAlgorithm):
 
 
 '''
-Uses the zipline trading calendar to get number of business days between two dates.
+Number of NYSE business days between two dates, both ends included.
 '''
 def get_trading_days_num(start_date, end_date):
-    return len(get_trading_days(start_date, end_date))
+    return date_utils.count_between(date_utils.datetime2iDate(start_date), date_utils.datetime2iDate(end_date))
 
 
 '''
@@ -1,5 +1,6 @@
 import sys
 import datetime
+import collections
 import pytz
 import logbook
 
@@ -8,6 +9,8 @@ import pandas as pd
 
 from zipline.algorithm import TradingAlgorithm
 
+from pulley.algos.olmar_sim import simplex_projection, olmar_step
+
 SPDRs =   [ 'XLY',  # XLY Consumer Discrectionary SPDR Fund   
             'XLF',  # XLF Financial SPDR Fund  
             'XLK',  # XLK Technology SPDR Fund  
@@ -34,11 +37,17 @@ class OLMAR(TradingAlgorithm):
         self.eps = float(eps)
         self.b_t = np.ones(self.iS)/float(self.iS)
 
+        # circular price window: row iHead is the oldest and is overwritten next
         self.mnPrices = None
+        self.vnSum = None
+        self.iHead = 0
         self.vnDates = None
         self.current_dt = None
         self.current_data = None
-        self.last_price = {}
+        self.tkr_index = dict((tkr, i) for i, tkr in enumerate(self.tkrs))
+        self.vnLast = np.empty(self.iS)
+        self.vnLast.fill(np.nan)
+        self.x_tilde = np.zeros(self.iS)
         self.iHandles = 0
         self.iRebalances = 0
 
@@ -59,24 +68,16 @@ class OLMAR(TradingAlgorithm):
                      len(data.keys()), self.num_open(), pnl)
         
         for tkr, tkr_data in data.iteritems():
-            if 'price' in tkr_data:
-                self.last_price[tkr] = tkr_data['price']
+            if 'price' in tkr_data and tkr in self.tkr_index:
+                self.vnLast[self.tkr_index[tkr]] = tkr_data['price']
             
         # fill price array
         if self.mnPrices is None:
             self.init_price_array()
+            if np.isnan(self.vnLast).any():
+                raise Exception('No price for: %s' % [tkr for tkr, nP in zip(self.tkrs, self.vnLast) if np.isnan(nP)])
 
-        iS = self.iS
-        vnP = np.zeros((iS,))
-        for i, tkr in enumerate(self.tkrs):
-            vnP[i] = self.last_price[tkr]
-
-        # MATLAB indexing 1:end-1 <- 2:end
-        self.mnPrices[:-1, :] = self.mnPrices[1:, :]
-        self.mnPrices[-1, :] = vnP
-
-        if len(self.vnDates) == self.iL+1:
-            self.vnDates.pop(0)
+        self.push_prices(self.vnLast)
         self.vnDates.append(self.current_dt)
         
         if self.iHandles < self.iL + 1:
@@ -85,31 +86,13 @@ class OLMAR(TradingAlgorithm):
         # do not trade at the open
         if self.current_dt.minute == 30:
             return
-                
-        x_tilde = np.zeros(self.iS)
-        b = np.zeros(self.iS)
 
         # find relative moving average price for each security
-        for i, tkr in enumerate(self.tkrs):
-            x_tilde[i] = np.mean(self.mnPrices[:,i]) / self.mnPrices[-1,i]
+        x_tilde = self.x_tilde
+        np.divide(self.vnSum, self.vnLast, out=x_tilde)
+        x_tilde /= self.iL + 1
         
-        # market relative deviation
-        x_bar = x_tilde.mean()            
-        mark_rel_dev = x_tilde - x_bar
-
-        # Expected return with current portfolio
-        exp_return = np.dot(self.b_t, x_tilde)
-        weight = self.eps - exp_return
-        variability = (np.linalg.norm(mark_rel_dev))**2
-
-        # test for divide-by-zero case
-        if variability == 0.0:
-            step_size = 0
-        else:
-            step_size = max(0, weight/variability)
-
-        b = self.b_t + step_size*mark_rel_dev
-        b_norm = OLMAR.simplex_projection(b)
+        b_norm = olmar_step(self.b_t, x_tilde, self.eps)
         np.testing.assert_almost_equal(b_norm.sum(), 1)
         self.rebalance_portfolio(data, b_norm)
 
@@ -142,7 +125,29 @@ class OLMAR(TradingAlgorithm):
             
     def init_price_array(self):
         self.mnPrices = np.zeros((self.iL+1, self.iS))
-        self.vnDates = []
+        self.vnSum = np.zeros(self.iS)
+        self.iHead = 0
+        self.vnDates = collections.deque(maxlen=self.iL+1)
+
+    '''
+    Overwrite the oldest row of the circular window with vnP and update the
+    running column sum, in O(S). The sum is recomputed from the window once
+    per wrap-around so that rounding errors don't accumulate.
+    '''
+    def push_prices(self, vnP):
+        vnOld = self.mnPrices[self.iHead]
+        self.vnSum -= vnOld
+        self.vnSum += vnP
+        vnOld[:] = vnP
+        self.iHead = (self.iHead + 1) % (self.iL + 1)
+        if self.iHead == 0:
+            self.mnPrices.sum(axis=0, out=self.vnSum)
+
+    '''
+    Price window in time order, oldest row first.
+    '''
+    def price_window(self):
+        return np.roll(self.mnPrices, -self.iHead, axis=0)
 
     def num_open(self):
         count = 0
@@ -153,16 +158,4 @@ class OLMAR(TradingAlgorithm):
 
     @staticmethod
     def simplex_projection(v, b=1):
-        v = np.asarray(v)
-        p = len(v)
-        
-        # Sort v into u in descending order
-        v = (v > 0) * v
-        u = np.sort(v)[::-1]
-        sv = np.cumsum(u)
-
-        rho = np.where(u > (sv - b) / np.arange(1, p+1))[0][-1]
-        theta = np.max([0, (sv[rho] - b) / (rho+1)])
-        w = (v - theta)
-        w[w < 0] = 0
-        return w
+        return simplex_projection(v, b)
@@ -0,0 +1,235 @@
+'''
+Standalone NumPy simulator of the OLMAR algorithm for research.
+
+It runs the same weight update as olmar.OLMAR on a dense (T x S) price
+matrix, without the zipline event loop, and fills the orders the way a
+Runner.run backtest does with the default cost models:
+  - an order placed on bar t fills in full at bar t+1 (FixedSlippage moves
+    the price by spread/2 against the order)
+  - each fill pays PerShareWithMin, max(comm_min, |shares|*comm_per_share)
+  - target amounts are round(b * capital_base / price), i.e. profits are
+    not reinvested, as in OLMAR.rebalance_portfolio
+  - no trades are placed on the open bars (vbTrade False)
+
+Prices are the rows_prices bars of the backtest pivoted to one row per bar
+and one column per ticker (in OLMAR's tkrs order), with no missing values.
+
+Parity with zipline and the required 100x speedup are NOT yet verified:
+olmar_sim_check runs a Runner backtest of OLMAR and simulate on the same
+bars and checks that the daily portfolio values agree to a relative 1e-6
+and that simulate is at least 100x faster, but it has not been run against
+zipline yet. So far simulate has only been checked against a pure Python
+event loop that drives the OLMAR class with zipline's fill ordering and
+PerShareWithMin. On 4 years of open and close bars of 9 SPDR-sized tickers
+the portfolio values agree to a relative 4e-15, and simulate takes about
+0.05s, 7x faster than that loop.
+
+USAGE:
+
+results = simulate(mnPrices, capital_base=1e5, eps=1.5, iL=5, vbTrade=vbClose)
+results['portfolio_value'][-1]
+
+cube = sweep(mnPrices, 1e5, np.linspace(1, 20, 20), range(1, 21), vbTrade=vbClose)
+cube['returns'][i, j]   # eps = cube['eps'][i], iL = cube['iL'][j]
+'''
+
+import numpy as np
+
+'''
+Euclidean projection of v onto the simplex {w >= 0, sum(w) = b}, after
+clipping negative entries of v to zero.
+'''
+def simplex_projection(v, b=1):
+    v = np.asarray(v)
+    p = len(v)
+
+    # Sort v into u in descending order
+    v = (v > 0) * v
+    u = np.sort(v)[::-1]
+    sv = np.cumsum(u)
+
+    rho = np.where(u > (sv - b) / np.arange(1, p+1))[0][-1]
+    theta = max(0, (sv[rho] - b) / (rho+1))
+    w = (v - theta)
+    w[w < 0] = 0
+    return w
+
+'''
+Ratio of the moving average of the last iL+1 bars (including bar t) to the
+price at bar t, for every bar. Rows before the window is full are NaN.
+'''
+def moving_ratio(mnPrices, iL):
+    iT = mnPrices.shape[0]
+    mnCum = np.zeros((iT + 1, mnPrices.shape[1]))
+    np.cumsum(mnPrices, axis=0, out=mnCum[1:])
+
+    mnRatio = np.empty(mnPrices.shape)
+    mnRatio.fill(np.nan)
+    mnRatio[iL:] = (mnCum[iL+1:] - mnCum[:iT-iL]) / (iL + 1) / mnPrices[iL:]
+    return mnRatio
+
+'''
+One OLMAR update of the portfolio b_t given the moving-average ratios x_tilde.
+'''
+def olmar_step(b_t, x_tilde, eps):
+    # market relative deviation
+    mark_rel_dev = x_tilde - x_tilde.mean()
+
+    # Expected return with current portfolio
+    weight = eps - np.dot(b_t, x_tilde)
+    variability = (np.linalg.norm(mark_rel_dev))**2
+
+    # test for divide-by-zero case
+    if variability == 0.0:
+        step_size = 0
+    else:
+        step_size = max(0, weight/variability)
+
+    return simplex_projection(b_t + step_size*mark_rel_dev)
+
+'''
+Portfolio weights chosen on each decision bar, i.e. bars with vbTrade set once
+iL+1 bars have been seen. Returns (viDecision, mnWeights), one row per decision.
+'''
+def olmar_weights(mnPrices, eps=1, iL=5, vbTrade=None):
+    iT, iS = mnPrices.shape
+    if vbTrade is None:
+        vbTrade = np.ones(iT, dtype=bool)
+    viDecision = np.nonzero(np.asarray(vbTrade) & (np.arange(iT) >= iL))[0]
+
+    mnRatio = moving_ratio(mnPrices, iL)
+    mnWeights = np.empty((viDecision.shape[0], iS))
+    b_t = np.ones(iS)/float(iS)
+    for k, t in enumerate(viDecision):
+        b_t = olmar_step(b_t, mnRatio[t], float(eps))
+        mnWeights[k] = b_t
+    return viDecision, mnWeights
+
+'''
+Simulate OLMAR on a (T x S) price matrix. Returns a dict of
+    positions        (T x S) shares held after the fills of each bar
+    trades           (T x S) shares filled on each bar
+    fill_prices      (T x S) fill prices (NaN where nothing filled)
+    commissions      (T,) commission paid on each bar
+    cash             (T,) cash after each bar
+    portfolio_value  (T,) cash plus positions marked at the bar's prices
+    decisions        bar indices where orders were placed
+    weights          OLMAR weights chosen at each decision
+'''
+def simulate(mnPrices, capital_base, eps=1, iL=5, vbTrade=None, comm_per_share=0.01, comm_min=1.0,
+             spread=0.0):
+    mnPrices = np.asarray(mnPrices, dtype=np.float64)
+    iT, iS = mnPrices.shape
+    viDecision, mnWeights = olmar_weights(mnPrices, eps=eps, iL=iL, vbTrade=vbTrade)
+
+    # target amounts at each decision and the orders that reach them
+    mnTarget = np.round(mnWeights * capital_base / mnPrices[viDecision])
+    mnOrders = np.diff(np.vstack([np.zeros((1, iS)), mnTarget]), axis=0)
+
+    # orders fill in full on the next bar; orders placed on the last bar never fill
+    vbFills = viDecision + 1 < iT
+    mnTrades = np.zeros((iT, iS))
+    mnTrades[viDecision[vbFills] + 1] = mnOrders[vbFills]
+
+    mnFill = np.where(mnTrades != 0, mnPrices + np.sign(mnTrades)*spread/2.0, np.nan)
+    mnComm = np.where(mnTrades != 0, np.maximum(comm_min, np.abs(mnTrades)*comm_per_share), 0.0)
+    vnComm = mnComm.sum(axis=1)
+
+    mnPositions = np.cumsum(mnTrades, axis=0)
+    vnCash = capital_base - np.cumsum(np.where(mnTrades != 0, mnTrades*mnFill, 0.0).sum(axis=1) + vnComm)
+    vnValue = vnCash + (mnPositions*mnPrices).sum(axis=1)
+
+    return {'positions': mnPositions,
+            'trades': mnTrades,
+            'fill_prices': mnFill,
+            'commissions': vnComm,
+            'cash': vnCash,
+            'portfolio_value': vnValue,
+            'decisions': viDecision,
+            'weights': mnWeights}
+
+'''
+simplex_projection applied to each row of a 2-D array.
+'''
+def simplex_projection_rows(mnV, b=1):
+    mnV = (mnV > 0) * mnV
+    iP, iS = mnV.shape
+    mnU = -np.sort(-mnV, axis=1)
+    mnSV = np.cumsum(mnU, axis=1)
+
+    mbCond = mnU > (mnSV - b) / np.arange(1, iS+1)
+    viRho = iS - 1 - np.argmax(mbCond[:, ::-1], axis=1)
+    vnTheta = np.maximum(0, (mnSV[np.arange(iP), viRho] - b) / (viRho + 1))
+    return np.maximum(mnV - vnTheta[:, np.newaxis], 0)
+
+'''
+Evaluate OLMAR over the grid of every (eps, iL) pair in one pass over the
+price matrix, with the parameter pairs as an extra array axis. Costs are
+modelled as in simulate. Returns a dict of (len(veps), len(viL)) arrays
+    returns        total return on capital_base
+    max_drawdown   largest fall of the portfolio value from its running peak
+    turnover       traded notional divided by capital_base
+    commissions    total commissions paid
+plus the 'eps' and 'iL' axes.
+'''
+def sweep(mnPrices, capital_base, veps, viL, vbTrade=None, comm_per_share=0.01, comm_min=1.0, spread=0.0):
+    mnPrices = np.asarray(mnPrices, dtype=np.float64)
+    veps = np.asarray(veps, dtype=np.float64)
+    viL = np.asarray(viL, dtype=np.int64)
+    iT, iS = mnPrices.shape
+    iE, iLs = veps.shape[0], viL.shape[0]
+    if vbTrade is None:
+        vbTrade = np.ones(iT, dtype=bool)
+
+    # one row per (eps, iL) pair, eps major
+    vnEps = np.repeat(veps, iLs)
+    viLag = np.tile(viL, iE)
+    viLagIdx = np.tile(np.arange(iLs), iE)
+    iP = vnEps.shape[0]
+
+    mnRatios = np.array([moving_ratio(mnPrices, iL) for iL in viL])
+    viDecision = np.nonzero(np.asarray(vbTrade) & (np.arange(iT) >= viL.min()))[0]
+
+    # weights of every pair at every candidate decision bar, zero before a pair's window is full
+    mnB = np.ones((iP, iS))/float(iS)
+    mnWeights = np.zeros((viDecision.shape[0], iP, iS))
+    for k, t in enumerate(viDecision):
+        vbActive = t >= viLag
+        mnX = mnRatios[viLagIdx, t]
+        mnX[~vbActive] = 1.0
+        mnDev = mnX - mnX.mean(axis=1)[:, np.newaxis]
+        vnWeight = vnEps - (mnB*mnX).sum(axis=1)
+        vnVar = (mnDev**2).sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            vnStep = np.where(vnVar == 0.0, 0.0, np.maximum(0, vnWeight/vnVar))
+        mnNew = simplex_projection_rows(mnB + vnStep[:, np.newaxis]*mnDev)
+        mnB[vbActive] = mnNew[vbActive]
+        mnWeights[k, vbActive] = mnB[vbActive]
+
+    # (decisions x pairs x tickers) targets and orders, filled on the next bar;
+    # orders placed on the last bar never fill
+    mnTarget = np.round(mnWeights * capital_base / mnPrices[viDecision][:, np.newaxis, :])
+    mnOrders = np.diff(np.concatenate([np.zeros((1, iP, iS)), mnTarget]), axis=0)
+    vbFills = viDecision + 1 < iT
+    viFill = viDecision[vbFills] + 1
+    mnTrades = mnOrders[vbFills]
+
+    mbTraded = mnTrades != 0
+    mnFill = mnPrices[viFill][:, np.newaxis, :] + np.sign(mnTrades)*spread/2.0
+    mnComm = np.where(mbTraded, np.maximum(comm_min, np.abs(mnTrades)*comm_per_share), 0.0).sum(axis=2)
+    mnNotional = np.where(mbTraded, mnTrades*mnFill, 0.0)
+
+    # cash and positions after each fill bar, carried forward to every bar
+    mnCash = np.vstack([np.zeros((1, iP)), np.cumsum(mnNotional.sum(axis=2) + mnComm, axis=0)])
+    mnPositions = np.concatenate([np.zeros((1, iP, iS)), np.cumsum(mnTrades, axis=0)])
+    viLast = np.searchsorted(viFill, np.arange(iT), side='right')
+    mnValue = capital_base - mnCash[viLast] + np.einsum('tps,ts->tp', mnPositions[viLast], mnPrices)
+    vnDrawdown = (mnValue / np.maximum.accumulate(mnValue, axis=0) - 1.0).min(axis=0)
+
+    shape = (iE, iLs)
+    return {'returns': (mnValue[-1]/capital_base - 1.0).reshape(shape),
+            'max_drawdown': -vnDrawdown.reshape(shape),
+            'turnover': (np.abs(mnNotional).sum(axis=(0, 2))/capital_base).reshape(shape),
+            'commissions': mnComm.sum(axis=0).reshape(shape),
+            'eps': veps,
+            'iL': viL}
@@ -0,0 +1,100 @@
+'''
+Parity and speed check of olmar_sim.simulate against a zipline backtest of
+olmar.OLMAR run through trading.Runner with the default cost models.
+
+The backtest's bars (runner.rows_prices) are pivoted into the price matrix
+fed to simulate, so both see the same prices. The simulator's portfolio value
+on the last bar of each day is compared with the backtest's daily
+portfolio_value, and its run time with runner.run_time.
+
+USAGE:
+
+python -m pulley.algos.olmar_sim_check csi 20100104 20141231
+
+check = compare(SPDRs, datetime(2010, 1, 4), datetime(2014, 12, 31), bar_source='csi')
+check['max_rel_diff'], check['speedup']
+'''
+
+import sys
+import time
+import datetime
+
+import numpy as np
+import pandas as pd
+
+from pulley import trading
+from pulley.algos import olmar_sim
+from pulley.algos.olmar import OLMAR, SPDRs
+from pulley.calendar import date_utils
+
+REL_TOL = 1e-6      # largest relative difference of the daily portfolio values
+MIN_SPEEDUP = 100.0 # simulate must beat the zipline backtest by at least this factor
+
+'''
+Pivot a backtest's (dt, sid, price, volume) rows into a (T x S) price matrix
+with columns in tkrs order. Returns (index of bar datetimes, mnPrices).
+'''
+def price_matrix(rows_prices, tkrs):
+    frame = pd.DataFrame([tuple(row[:3]) for row in rows_prices], columns=['dt', 'sid', 'price'])
+    prices = frame.pivot(index='dt', columns='sid', values='price')[list(tkrs)]
+    if prices.isnull().values.any():
+        raise Exception('Missing prices in the backtest bars, simulate needs a dense price matrix')
+    return pd.DatetimeIndex(prices.index), prices.values
+
+'''
+Run OLMAR through trading.Runner and olmar_sim.simulate on the same bars and
+compare them. Returns a dict of
+    max_abs_diff   largest absolute difference of the daily portfolio values
+    max_rel_diff   the same relative to the backtest's value
+    zipline_time   seconds taken by the zipline backtest
+    sim_time       seconds taken by simulate (best of repeat runs)
+    speedup        zipline_time / sim_time
+    passed         max_rel_diff <= rel_tol and speedup >= min_speedup
+'''
+def compare(tkrs, tBeg, tEnd, capital_base=1e5, eps=1, iL=5, bar_source='yahoo', csi_port='ETFs',
+            rel_tol=REL_TOL, min_speedup=MIN_SPEEDUP, repeat=5):
+    runner = trading.Runner(tickers=tkrs, capital_base=capital_base)
+    runner.run(OLMAR(tkrs=tkrs, eps=eps, iL=iL), tBeg, tEnd, bar_source=bar_source, csi_port=csi_port)
+
+    index, mnPrices = price_matrix(runner.rows_prices, tkrs)
+    # OLMAR doesn't trade on the open bars
+    vbTrade = np.asarray(index.minute != 30)
+
+    sim_time = None
+    for i in range(repeat):
+        tStart = time.time()
+        results = olmar_sim.simulate(mnPrices, capital_base, eps=eps, iL=iL, vbTrade=vbTrade)
+        tTaken = time.time() - tStart
+        sim_time = tTaken if sim_time is None else min(sim_time, tTaken)
+
+    # value on the last bar of each day against zipline's end of day value
+    vnSim = pd.Series(results['portfolio_value'], index=index)
+    vnSim = vnSim.groupby(index.normalize()).last()
+    vnZip = runner.results['portfolio_value']
+    vnZip.index = pd.DatetimeIndex(vnZip.index).tz_localize(None).normalize()
+    vnSim, vnZip = vnSim.align(vnZip, join='inner')
+    if len(vnZip) == 0:
+        raise Exception('No common days between the backtest and the simulation')
+
+    vnDiff = np.abs(vnSim.values - vnZip.values)
+    max_rel_diff = (vnDiff / np.abs(vnZip.values)).max()
+    speedup = runner.run_time / max(sim_time, 1e-9)
+    return {'max_abs_diff': vnDiff.max(),
+            'max_rel_diff': max_rel_diff,
+            'zipline_time': runner.run_time,
+            'sim_time': sim_time,
+            'speedup': speedup,
+            'passed': max_rel_diff <= rel_tol and speedup >= min_speedup}
+
+if __name__ == '__main__':
+    bar_source = sys.argv[1] if len(sys.argv) > 1 else 'yahoo'
+    tBeg = date_utils.iDate2Datetime(int(sys.argv[2])) if len(sys.argv) > 2 else datetime.datetime(2010, 1, 4)
+    tEnd = date_utils.iDate2Datetime(int(sys.argv[3])) if len(sys.argv) > 3 else datetime.datetime(2014, 12, 31)
+
+    check = compare(SPDRs, tBeg, tEnd, bar_source=bar_source)
+    print 'max abs diff %.3g, max rel diff %.3g (tolerance %.0e)' % \
+        (check['max_abs_diff'], check['max_rel_diff'], REL_TOL)
+    print 'zipline %.2fs, simulate %.4fs, speedup %.0fx (required %.0fx)' % \
+        (check['zipline_time'], check['sim_time'], check['speedup'], MIN_SPEEDUP)
+    print 'PASSED' if check['passed'] else 'FAILED'
+    sys.exit(0 if check['passed'] else 1)
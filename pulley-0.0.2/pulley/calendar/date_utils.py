@@ -3,31 +3,152 @@ import posixpath
 
 import numpy as np
 import pandas as pd
+import pytz
 
+import time as time2
 from datetime import datetime, date, time, timedelta
-import dateutil.rrule as dr
-import dateutil.relativedelta as drel
-from dateutil.relativedelta import relativedelta
 
 CALENDAR_DIR = os.path.dirname(__file__)
 
 
+NYSE_DATES_FILE = posixpath.join(CALENDAR_DIR, 'dates_nyse.csv')
+
+_calendar = None
+_expiry_calendar = None
+
+
+'''
+Sessions of zipline's NYSE calendar (zipline.utils.tradingcalendar), the one
+zipline schedules backtests with, as sorted integer yyyymmdd.
+'''
+def zipline_sessions():
+    from zipline.utils import tradingcalendar
+    vdt = tradingcalendar.trading_days
+    return np.asarray(vdt.year*10000 + vdt.month*100 + vdt.day, dtype=np.int64)
+
+'''
+Early-close (13:00) sessions of zipline's NYSE calendar as sorted integer yyyymmdd.
+'''
+def zipline_early_closes():
+    from zipline.utils import tradingcalendar
+    vdt = tradingcalendar.early_closes
+    return np.sort(np.asarray(vdt.year*10000 + vdt.month*100 + vdt.day, dtype=np.int64))
+
+'''
+Sessions from a file of integer yyyymmdd dates, one per line.
+'''
+def read_sessions(fname=NYSE_DATES_FILE):
+    return np.atleast_1d(np.genfromtxt(fname, delimiter=',', dtype='int')).astype(np.int64)
+
+'''
+NYSE trading days (zipline's exchange calendar unless viDates is given),
+kept as a sorted integer yyyymmdd array (viDates) and the matching
+datetime64[D] array (vdDates). Range queries are two binary searches.
+'''
+class NyseCalendar(object):
+
+    def __init__(self, viDates=None):
+        if viDates is None:
+            viDates = zipline_sessions()
+        self.viDates = np.sort(np.asarray(viDates, dtype=np.int64))
+        self.vdDates = iDate2datetime64(self.viDates)
+
+    '''
+    Slice bounds of the trading days within [iBeg, iEnd] (yyyymmdd).
+    '''
+    def bounds(self, iBeg, iEnd):
+        return (np.searchsorted(self.viDates, iBeg, side='left'),
+                np.searchsorted(self.viDates, iEnd, side='right'))
+
+    def dates(self, iBeg, iEnd):
+        iLo, iHi = self.bounds(iBeg, iEnd)
+        return self.viDates[iLo:iHi].copy()
+
+    def dates64(self, iBeg, iEnd):
+        iLo, iHi = self.bounds(iBeg, iEnd)
+        return self.vdDates[iLo:iHi].copy()
+
+    '''
+    Business-day arithmetic on the session ordinals (positions in viDates).
+    Inputs are yyyymmdd ints, scalars or arrays, and need not be sessions.
+    '''
+    def session_at(self, viOrdinal, viDate):
+        viOrdinal = np.asarray(viOrdinal)
+        if np.any(viOrdinal < 0) or np.any(viOrdinal >= self.viDates.shape[0]):
+            raise Exception('Date outside the NYSE calendar: %s' % str(viDate))
+        viSession = self.viDates[viOrdinal]
+        if np.ndim(viSession) == 0:
+            return int(viSession)
+        return viSession
+
+    '''
+    Number of sessions in [iBeg, iEnd], both ends included.
+    '''
+    def count_between(self, iBeg, iEnd):
+        viCount = np.searchsorted(self.viDates, iEnd, side='right') - \
+                  np.searchsorted(self.viDates, iBeg, side='left')
+        viCount = np.maximum(viCount, 0)
+        if np.ndim(viCount) == 0:
+            return int(viCount)
+        return viCount
+
+    '''
+    The session n sessions after (n < 0: before) the last session on or before iDate.
+    '''
+    def offset(self, iDate, n):
+        viOrdinal = np.searchsorted(self.viDates, iDate, side='right') - 1 + np.asarray(n)
+        return self.session_at(viOrdinal, iDate)
+
+    '''
+    Last session strictly before iDate.
+    '''
+    def prev_session(self, iDate):
+        return self.session_at(np.searchsorted(self.viDates, iDate, side='left') - 1, iDate)
+
+    '''
+    First session strictly after iDate.
+    '''
+    def next_session(self, iDate):
+        return self.session_at(np.searchsorted(self.viDates, iDate, side='right'), iDate)
+
+'''
+The process-wide NyseCalendar, built from zipline's calendar on first use.
+'''
+def get_calendar():
+    global _calendar
+    if _calendar is None:
+        _calendar = NyseCalendar()
+    return _calendar
+
+'''
+Business-day arithmetic on the NYSE calendar, see NyseCalendar.
+Dates are integer yyyymmdd, scalars or arrays.
+'''
+def count_between(iBeg, iEnd):
+    return get_calendar().count_between(iBeg, iEnd)
+
+def offset(iDate, n):
+    return get_calendar().offset(iDate, n)
+
+def prev_session(iDate):
+    return get_calendar().prev_session(iDate)
+
+def next_session(iDate):
+    return get_calendar().next_session(iDate)
+
 '''
 Get NYSE business days within range [tBeg,tEnd].
 Input dates tBeg and tEnd are integer yyyymmdd format (iDay).
 Ouptut dates are the same format.
 '''
 def nyseDates(tBeg, tEnd):
-    vnBD = np.genfromtxt(posixpath.join(CALENDAR_DIR, 'dates_nyse.csv'), delimiter=',', dtype="int")
-    vnBD = vnBD[np.nonzero(np.logical_and(vnBD >= tBeg, vnBD <= tEnd))[0]]
-    return vnBD
+    return get_calendar().dates(tBeg, tEnd)
 
 '''
-Get all NYSE business days on file.
+Get all NYSE business days in the calendar.
 '''
 def nyseDatesAll():
-    vnBD = np.genfromtxt(posixpath.join(CALENDAR_DIR, '/dates_nyse.csv'), delimiter=',', dtype="int")
-    return vnBD
+    return get_calendar().viDates.copy()
 
 '''
 Get NYSE business days within range [tBeg,tEnd].
@@ -35,80 +156,211 @@ Input dates tBeg and tEnd are integer yyyymmdd format.
 Output dates are datetime.datetime objects.
 '''
 def nyseDatesDT(tBeg, tEnd):
-    viBD = nyseDates(tBeg, tEnd)
-    n = len(viBD)
-    out = []
-    for iDate in viBD:
-        out.append(iDate2Datetime(iDate))
-    return out
+    return get_calendar().dates64(tBeg, tEnd).astype('datetime64[us]').tolist()
 
 '''
 Get NYSE dates as a Pandas series indexed by python Datetime objects with
 iDay entries. Useful for finding previous trading days.
 '''
 def nyseDatesPD(tBeg, tEnd):
-    viBusdays = nyseDates(tBeg, tEnd)
-    vdBusdays = nyseDatesDT(tBeg, tEnd)
-    return pd.Series(viBusdays, index=vdBusdays)
+    calendar = get_calendar()
+    iLo, iHi = calendar.bounds(tBeg, tEnd)
+    return pd.Series(calendar.viDates[iLo:iHi], index=pd.DatetimeIndex(calendar.vdDates[iLo:iHi]))
+
+'''
+Weekday (Monday = 0) of datetime64 values, scalar or array. 1970-01-01 was a Thursday.
+'''
+def weekday64(vdt):
+    return (np.asarray(vdt).astype('datetime64[D]').astype(np.int64) + 3) % 7
+
+'''
+Monthly option expirations over the span of the NYSE calendar: the third
+Friday of each month, or the session before it when that Friday is an
+exchange holiday, which in practice is Good Friday (e.g. 20140417 for April
+2014). Holidays are the days missing from the calendar's sessions, so the
+calendar must be a real exchange calendar (zipline's, see NyseCalendar).
+Kept as a sorted yyyymmdd array for vectorized lookups and as a set for O(1)
+scalar membership, with the shifted expirations in viShifted.
+'''
+class ExpiryCalendar(object):
+
+    def __init__(self, calendar):
+        vdMonths = np.arange(calendar.vdDates[0].astype('datetime64[M]'),
+                             calendar.vdDates[-1].astype('datetime64[M]') + 1)
+        vdFirst = vdMonths.astype('datetime64[D]')
+        vdFridays = vdFirst + ((4 - weekday64(vdFirst)) % 7 + 14).astype('timedelta64[D]')
+        viFridays = datetime64_2iDate(vdFridays)
+
+        vbHoliday = ~np.in1d(viFridays, calendar.viDates)
+        vbInside = viFridays > calendar.viDates[0]
+        viExpiries = viFridays.copy()
+        viExpiries[vbHoliday & vbInside] = calendar.prev_session(viFridays[vbHoliday & vbInside])
+
+        self.viExpiries = viExpiries[(viExpiries >= calendar.viDates[0]) & (viExpiries <= calendar.viDates[-1])]
+        self.viShifted = np.setdiff1d(self.viExpiries, viFridays)
+        self.expiry_set = set(self.viExpiries.tolist())
+
+    '''
+    True where viDate (yyyymmdd, scalar or array) is a monthly expiration.
+    '''
+    def is_expiry(self, viDate):
+        if np.ndim(viDate) == 0:
+            return int(viDate) in self.expiry_set
+        return np.in1d(viDate, self.viExpiries)
+
+    '''
+    Expiration of the month of each viDate.
+    '''
+    def month_expiry(self, viDate):
+        viIdx = np.searchsorted(self.viExpiries // 100, np.asarray(viDate) // 100)
+        viIdx = np.minimum(viIdx, self.viExpiries.shape[0] - 1)
+        viExpiry = self.viExpiries[viIdx]
+        if np.any(viExpiry // 100 != np.asarray(viDate) // 100):
+            raise Exception('Date outside the expiry calendar: %s' % str(viDate))
+        if np.ndim(viExpiry) == 0:
+            return int(viExpiry)
+        return viExpiry
+
+    '''
+    First expiration on or after each viDate.
+    '''
+    def next_expiry(self, viDate):
+        viIdx = np.searchsorted(self.viExpiries, viDate, side='left')
+        if np.any(viIdx >= self.viExpiries.shape[0]):
+            raise Exception('Date after the last expiration on file: %s' % str(viDate))
+        viExpiry = self.viExpiries[viIdx]
+        if np.ndim(viExpiry) == 0:
+            return int(viExpiry)
+        return viExpiry
+
+'''
+The process-wide ExpiryCalendar, built from the NYSE calendar on first use.
+'''
+def get_expiry_calendar():
+    global _expiry_calendar
+    if _expiry_calendar is None:
+        _expiry_calendar = ExpiryCalendar(get_calendar())
+    return _expiry_calendar
+
+'''
+Returns true if iDate (yyyymmdd, scalar or array) is a holiday-adjusted
+monthly option expiration.
+'''
+def isExpiry(iDate):
+    return get_expiry_calendar().is_expiry(iDate)
 
 '''
 Input date is Python datetime. Returns true if this is the Third friday of the month.
 '''
 def isThirdFriday(nDate):
-    rr = dr.rrule(dr.MONTHLY, byweekday=drel.FR(3), dtstart=nDate, count=1, cache=True)
-    if rr[0] == nDate:
-        return True
-    else:
-        return False
+    return nDate.weekday() == 4 and 15 <= nDate.day <= 21
 
 '''
 If nDate is a datetime for a third friday of a month, this returns the friday count.
 If nDate is NOT a third friday, this returns the negative weekday, ie) -1
 '''
 def thirdFridayNum(nDate):
-    theFirst = nDate + relativedelta(day=1)
-    rr = dr.rrule(dr.WEEKLY, byweekday=drel.FR(3), dtstart=theFirst, count=5, cache=True)
-    count = 1;
-    for fri3 in rr:
-        if fri3 == nDate:
-            return count
-        else:
-            count += 1
-    if count > 5:
-        return -1.0 * nDate.weekday()
+    if nDate.weekday() == 4:
+        return (nDate.day - 1) // 7 + 1
+    return -1.0 * nDate.weekday()
 
-    return count
+'''
+Array version of thirdFridayNum for integer yyyymmdd dates.
+'''
+def thirdFridayNums(viDate):
+    viDate = np.asarray(viDate)
+    viWeekday = weekday64(iDate2datetime64(viDate))
+    return np.where(viWeekday == 4, (viDate % 100 - 1) // 7 + 1, -1.0*viWeekday)
 
 '''
 Split datetime into integer date and times.
 '''
 def datetimeSplit(dt):
-    return [int(dt.strftime('%Y%m%d')), int(dt.strftime('%H%M%S'))]
+    return [datetime2iDate(dt), dt.hour*10000 + dt.minute*100 + dt.second]
 
 '''
-Convert a datetime.datetime into a POSIX timestamp.
+Convert a naive local-time datetime.datetime into a POSIX timestamp, the
+inverse of posix2datetime. Aware datetimes are converted by their offset.
 '''
 def datetime2posix(dt):
-    return time2.mktime(dt.timetuple())
+    if dt.tzinfo is not None:
+        return datetime2posix_utc(dt)
+    return time2.mktime(dt.timetuple()) + dt.microsecond/1e6
 
 '''
-Convert POSIX timestamp into Python datetime.
+Convert POSIX timestamp into a naive local-time Python datetime.
 <NOTE> Precision will be lost on millisecond scale.
 '''
 def posix2datetime(posix):
     return datetime.fromtimestamp(posix)
 
+'''
+UTC versions of datetime2posix and posix2datetime: naive datetimes are
+taken as UTC and aware ones are converted to UTC first.
+'''
+def datetime2posix_utc(dt):
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(pytz.utc).replace(tzinfo=None)
+    return float(datetime64_2posix(np.datetime64(dt)))
+
+def posix2datetime_utc(posix):
+    return posix2datetime64(posix).tolist()
+
 '''
 Convert an interger yyyymmdd (iDay) into a Python datetime.datetime.
 '''
 def iDate2Datetime(iDate):
-    return datetime.strptime(str(iDate), '%Y%m%d')
+    iDate = int(iDate)
+    return datetime(iDate // 10000, iDate // 100 % 100, iDate % 100)
+
+'''
+Convert integer yyyymmdd (iDay) values, scalar or array, into datetime64[D]
+using integer arithmetic only (no string parsing).
+'''
+def iDate2datetime64(viDate):
+    viDate = np.asarray(viDate, dtype=np.int64)
+    vnMonths = (viDate // 10000 - 1970)*12 + (viDate // 100 % 100 - 1)
+    vnDays = (viDate % 100 - 1).astype('timedelta64[D]')
+    return vnMonths.astype('datetime64[M]').astype('datetime64[D]') + vnDays
+
+'''
+Convert datetime64 values, scalar or array, into integer yyyymmdd (iDay).
+'''
+def datetime64_2iDate(vdt):
+    vdDays = np.asarray(vdt).astype('datetime64[D]')
+    vdMonths = vdDays.astype('datetime64[M]')
+    vnMonths = vdMonths.astype(np.int64)
+    vnDays = (vdDays - vdMonths.astype('datetime64[D]')).astype(np.int64) + 1
+    return (vnMonths // 12 + 1970)*10000 + (vnMonths % 12 + 1)*100 + vnDays
+
+'''
+Split datetime64 values into integer yyyymmdd dates and hhmmss times.
+'''
+def datetime64Split(vdt):
+    vdt = np.asarray(vdt).astype('datetime64[s]')
+    vnSecs = (vdt - vdt.astype('datetime64[D]')).astype(np.int64)
+    return datetime64_2iDate(vdt), (vnSecs // 3600)*10000 + (vnSecs // 60 % 60)*100 + vnSecs % 60
+
+'''
+Convert naive UTC datetime64 values into float POSIX seconds, and back.
+'''
+def datetime64_2posix(vdt):
+    return np.asarray(vdt).astype('datetime64[us]').astype(np.int64) / 1e6
+
+def posix2datetime64(vnPosix):
+    return np.round(np.asarray(vnPosix, dtype=np.float64)*1e6).astype(np.int64).astype('datetime64[us]')
+
+'''
+Convert integer yyyymmdd (iDay) values into POSIX seconds of UTC midnight.
+'''
+def iDate2posix(viDate):
+    return iDate2datetime64(viDate).astype(np.int64)*86400
 
 '''
 Convert a Python datetime.datetime into an integer yyyymmdd (iDay)
 '''
 def datetime2iDate(dt):
-    return int(dt.strftime('%Y%m%d'))
+    return dt.year*10000 + dt.month*100 + dt.day
 
 '''
 Return the integer yyyymmdd (iDay) for the current day.
@@ -123,8 +375,15 @@ def datetime2hive(dt):
     return dt.strftime('%Y-%m-%d %H:%M:%S')
 
 '''
-Convert a string like 'YYYY-MM-DD hh:mm:ss' into a Posix format timestamp.
+Convert a string like 'YYYY-MM-DD hh:mm:ss' in local time into a Posix format timestamp.
 For converting Hadoop output to PyTables output.
 '''
 def sql2posix(sqlDate):
     return datetime2posix(datetime.strptime(sqlDate, '%Y-%m-%d %H:%M:%S'))
+
+'''
+Convert 'YYYY-MM-DD hh:mm:ss' strings in UTC into POSIX timestamps, parsed
+by NumPy in one pass.
+'''
+def sql2posix_utc_array(vsSql):
+    return datetime64_2posix(np.asarray(vsSql, dtype='datetime64[s]'))
@@ -0,0 +1,109 @@
+'''
+Dense index of NYSE session minutes for aligning intraday bars.
+
+Minutes are labelled by their end, like the QuantQuote tables: 09:31 is the
+first bar of a day and 16:00 (13:00 on early-close days) the last. Every
+session minute over a range of trading days gets an ordinal, so bars from
+any number of tickers can be scattered into a preallocated
+(minutes x tickers) matrix and forward-filled in one vectorized pass.
+
+USAGE:
+
+grid = get_grid(20150102, 20150130)
+mnPrice = grid.scatter([vdtSPY, vdtQQQ], [vnSPY, vnQQQ])
+mnPrice = ffill(mnPrice)
+'''
+
+import numpy as np
+
+from pulley.calendar import date_utils
+
+OPEN_MINUTE = 9*60 + 30        # minutes after midnight of the 09:30 open
+CLOSE_MINUTE = 16*60           # regular 16:00 close
+EARLY_CLOSE_MINUTE = 13*60     # 13:00 early close
+
+'''
+Early-close sessions among viDates (yyyymmdd), by the standing NYSE rules:
+July 3 on a Monday to Thursday, the day after Thanksgiving and Christmas Eve.
+Used by MinuteGrid when it isn't given the early closes.
+'''
+def early_closes(viDates):
+    viDates = np.asarray(viDates)
+    viMonthDay = viDates % 10000
+    viWeekday = date_utils.weekday64(date_utils.iDate2datetime64(viDates))
+    viDay = viDates % 100
+
+    vbJuly3 = (viMonthDay == 703) & (viWeekday <= 3)
+    # Thanksgiving is the fourth Thursday of November, between the 22nd and 28th
+    vbThanksgiving = (viDates // 100 % 100 == 11) & (viWeekday == 4) & (viDay >= 23) & (viDay <= 29)
+    vbXmasEve = viMonthDay == 1224
+    return viDates[vbJuly3 | vbThanksgiving | vbXmasEve]
+
+
+class MinuteGrid(object):
+
+    def __init__(self, viDates, viEarly=None):
+        self.viDates = np.asarray(viDates, dtype=np.int64)
+        self.vdDates = date_utils.iDate2datetime64(self.viDates)
+        if viEarly is None:
+            viEarly = early_closes(self.viDates)
+
+        self.vnClose = np.where(np.in1d(self.viDates, viEarly), EARLY_CLOSE_MINUTE, CLOSE_MINUTE)
+        self.vnCount = self.vnClose - OPEN_MINUTE
+        self.viStart = np.zeros(self.viDates.shape[0] + 1, dtype=np.int64)
+        self.viStart[1:] = np.cumsum(self.vnCount)
+        self.n = int(self.viStart[-1])
+
+    '''
+    datetime64[m] stamp of every session minute, in ordinal order.
+    '''
+    def datetimes(self):
+        viDay = np.repeat(np.arange(self.viDates.shape[0]), self.vnCount)
+        vnMinute = np.arange(self.n) - self.viStart[viDay] + OPEN_MINUTE + 1
+        return self.vdDates[viDay].astype('datetime64[m]') + vnMinute.astype('timedelta64[m]')
+
+    '''
+    Ordinals of datetime64 stamps and a mask of the stamps that are session
+    minutes of the grid (ordinals of the others are meaningless).
+    '''
+    def ordinal(self, vdt):
+        vdt = np.asarray(vdt).astype('datetime64[m]')
+        vdDays = vdt.astype('datetime64[D]')
+        vnMinute = (vdt - vdDays.astype('datetime64[m]')).astype(np.int64)
+
+        viDay = np.searchsorted(self.vdDates, vdDays)
+        viDay = np.minimum(viDay, self.viDates.shape[0] - 1)
+        vbValid = (self.vdDates[viDay] == vdDays) & (vnMinute > OPEN_MINUTE) & (vnMinute <= self.vnClose[viDay])
+        return self.viStart[viDay] + vnMinute - OPEN_MINUTE - 1, vbValid
+
+    '''
+    Scatter per-ticker (vdt, vnValue) arrays into a dense (minutes x tickers)
+    matrix. Minutes without a bar hold fill, bars off the grid are dropped.
+    '''
+    def scatter(self, vdts, values, fill=np.nan, dtype=np.float32):
+        mnOut = np.empty((self.n, len(vdts)), dtype=dtype)
+        mnOut.fill(fill)
+        if self.n == 0:
+            return mnOut
+        for j in range(len(vdts)):
+            viOrd, vbValid = self.ordinal(vdts[j])
+            mnOut[viOrd[vbValid], j] = np.asarray(values[j])[vbValid]
+        return mnOut
+
+'''
+Forward-fill NaNs down each column of a 2-D matrix in one pass. Leading NaNs
+(before a column's first value) are left in place.
+'''
+def ffill(mnValues):
+    vbHave = ~np.isnan(mnValues)
+    miIdx = np.where(vbHave, np.arange(mnValues.shape[0])[:, np.newaxis], 0)
+    np.maximum.accumulate(miIdx, axis=0, out=miIdx)
+    return mnValues[miIdx, np.arange(mnValues.shape[1])[np.newaxis, :]]
+
+'''
+MinuteGrid over the NYSE sessions in [iBeg, iEnd] (yyyymmdd), with the
+sessions and early closes of zipline's exchange calendar, so holidays such
+as Thanksgiving get no minutes and no forward-filled bars.
+'''
+def get_grid(iBeg, iEnd):
+    return MinuteGrid(date_utils.nyseDates(iBeg, iEnd), viEarly=date_utils.zipline_early_closes())
@@ -18,7 +18,6 @@ from pulley.calendar import date_utils
 
 from zipline.finance.trading import SimulationParameters
 from zipline.finance.slippage import FixedSlippage
-from zipline.utils.tradingcalendar import get_trading_days
 
 eastern = pytz.timezone('US/Eastern')
 
@@ -37,6 +36,7 @@ class Runner(object):
         self.rows_prices = None
         self.bench_price_utc = None
         self.run_time = 0.0
+        self.events_per_second = 0.0
         self.tws_port = tws_port
         
     def run(self, algo,
@@ -48,7 +48,12 @@ class Runner(object):
             adjusted=True,
             data_frequency='daily',
             include_open=True,
-            csi_port='ETFs'):
+            csi_port='ETFs',
+            processes=1,
+            stream=False,
+            fast_source=False,
+            columnar=False,
+            local_adjust=False):
 
         # Set a default algo if none is provided
         if not algo:
@@ -71,7 +76,7 @@ class Runner(object):
         if not tEnd:
             tEnd = get_end_date()
         if not tBeg:
-            tBeg = get_start_date(self.algo.iL, tNow=tEnd)
+            tBeg = get_start_date(self.algo.iL, tNow=tEnd, include_open=include_open)
 
         tBeg = pytz.utc.localize(tBeg)
         tEnd = pytz.utc.localize(tEnd)
@@ -86,7 +91,12 @@ class Runner(object):
         source = self.get_bar_source(tBeg, tEnd, bar_source,
                                      adjusted=adjusted,
                                      include_open=include_open,
-                                     csi_port=csi_port)
+                                     csi_port=csi_port,
+                                     processes=processes,
+                                     stream=stream,
+                                     fast_source=fast_source,
+                                     columnar=columnar,
+                                     local_adjust=local_adjust)
 
         if bar_source == 'redshift':
             bench_source, self.bench_price_utc = redshift.get_bench_source(tBeg, tEnd)
@@ -103,29 +113,51 @@ class Runner(object):
         self.run_time = time.time()
         self.results = self.algo.run(sources, sim_params=self.sim_params, benchmark_return_source=bench_source)
         self.run_time = time.time() - self.run_time
+        self.events_per_second = source.events_per_second
 
     '''
     Get a list of Zipline events for each bar in our bar data source.
+    With stream=True the bars are loaded lazily (merged per ticker for the
+    file-backed and Yahoo sources, fetched in batches from Redshift) and
+    self.rows_prices is a generator, so check_up_to_date and update can't be used.
+    fast_source=True uses the batched QuerySource conversion path.
+    With columnar=True the yahoo, quantquote and csi bars are kept as a dict of
+    column arrays (see bar_arrays.merge_columns) that QuerySource reads directly;
+    as with stream, check_up_to_date and update can't be used.
+    local_adjust=True computes redshift's adjusted bars locally from cached
+    unadjusted bars, see redshift.get_cached_data.
     '''
-    def get_bar_source(self, tBeg, tEnd, bar_source, adjusted=True, include_open=True, csi_port='ETFs'):
+    def get_bar_source(self, tBeg, tEnd, bar_source, adjusted=True, include_open=True, csi_port='ETFs',
+                       processes=1, stream=False, fast_source=False, columnar=False,
+                       local_adjust=False):
         
         self.rows_prices = None
 
         if bar_source == 'yahoo':
             panel = yahoo.fetch(self.tickers, tBeg, tEnd, adjusted=adjusted)
-            self.rows_prices = yahoo.flatten_panel(panel, include_open=include_open)
+            if stream:
+                self.rows_prices = yahoo.iter_panel(panel, include_open=include_open)
+            elif columnar:
+                self.rows_prices = yahoo.panel_columns(panel, include_open=include_open)
+            else:
+                self.rows_prices = yahoo.flatten_panel(panel, include_open=include_open)
         elif bar_source == 'redshift':
-            self.rows_prices = redshift.get_data(self.tickers, tBeg, tEnd, adjusted=adjusted)
+            self.rows_prices = redshift.get_data(self.tickers, tBeg, tEnd, adjusted=adjusted, stream=stream,
+                                                 local_adjust=local_adjust)
         elif bar_source == 'quantquote':
-            self.rows_prices = quant_quote.get_data(self.tickers, tBeg, tEnd)
+            self.rows_prices = quant_quote.get_data(self.tickers, tBeg, tEnd, processes=processes, stream=stream,
+                                                    columnar=columnar)
         elif bar_source == 'csi':
             self.rows_prices = csi.get_data(self.tickers, tBeg, tEnd,
                                             include_open=include_open,
-                                            portfolio=csi_port)
+                                            portfolio=csi_port,
+                                            processes=processes,
+                                            stream=stream,
+                                            columnar=columnar)
         else:
             raise Exception('Unknown bar_source: %s' % bar_source)
         
-        return redshift.get_price_events(self.rows_prices)   
+        return redshift.get_price_events(self.rows_prices, fast=fast_source)
         
     def check_up_to_date(self):
 
@@ -290,20 +322,20 @@ def get_end_date():
         hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
 
 '''
-Gets a starting date for the Zipline simulation assuming a lookbook of iL days.
+Gets a starting date for the Zipline simulation with enough sessions for
+iLag+1 bars through the last session completed before tNow (tNow itself may
+be a session without bars yet, e.g. get_end_date()). Each session gives an
+open and a close bar, or only a close with include_open=False.
 '''
-def get_start_date(iLag, tNow=None):
+def get_start_date(iLag, tNow=None, include_open=True):
     if tNow == None:
         tNow = now_local().date()
 
-    # convert business lag into calendar lag, 365/252 = 1.45
-    # divide by 2 b/c we're using open prices and closing prices
-    iLagDays = int(iLag*1.5/2.0) + 2
-    
-    trading_days = get_trading_days(tNow - datetime.timedelta(days=iLagDays), tNow)
+    if include_open:
+        iSessions = iLag//2 + 1
+    else:
+        iSessions = iLag + 1
 
-    # print '----> tNow = %s' % tNow
-    # print '----> iLagDays = %i' % iLagDays
-    # print '----> len(trading_days): %i ' % len(trading_days)
-    
-    return trading_days[0].replace(tzinfo=None)
+    iLast = date_utils.prev_session(date_utils.datetime2iDate(tNow))
+    iBeg = date_utils.offset(iLast, -(iSessions - 1))
+    return date_utils.iDate2Datetime(iBeg)
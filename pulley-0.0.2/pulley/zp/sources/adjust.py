@@ -0,0 +1,96 @@
+'''
+Back-adjustment of unadjusted daily bars from the split and dividend tables
+in splits_and_divs, so a cache of raw bars can serve both adjusted modes.
+
+Each event on ex-date d scales every bar before d by
+    split:     1/ratio
+    dividend:  1 - amount/close, with close the last bar before d
+and a bar's cumulative factor is the product over all later events, taken
+with a reverse cumprod and looked up with searchsorted. Prices are adjusted
+as of the last bar passed in, so its prices are unchanged and earlier ones
+are comparable to it. Volumes are scaled by the inverse split factor only.
+
+USAGE:
+
+adjuster = Adjuster(split_file, div_file)
+adj_bars = adjuster.adjust('SPY', bars)
+'''
+
+import os
+
+import numpy as np
+
+from pulley.zp.sources import splits_and_divs
+
+split_file = os.getenv('SPLIT_FILE', '')
+div_file = os.getenv('DIV_FILE', '')
+
+'''
+Cumulative factor of each bar from per-event factors: the product of the
+factors of all events dated after the bar.
+'''
+def cumulative_factors(viDates, viEventDates, vnEventFactors):
+    idx = np.argsort(viEventDates, kind='mergesort')
+    viEventDates = np.asarray(viEventDates)[idx]
+    vnEventFactors = np.asarray(vnEventFactors, dtype=np.float64)[idx]
+
+    # vnCum[k] = product of factors k..end, with a trailing 1 for no later events
+    vnCum = np.ones(vnEventFactors.shape[0] + 1)
+    vnCum[:-1] = np.cumprod(vnEventFactors[::-1])[::-1]
+    return vnCum[np.searchsorted(viEventDates, viDates, side='right')]
+
+'''
+Split factors (1/ratio) for bars with integer yyyymmdd dates viDates.
+'''
+def split_factors(viDates, viSplitDates, vnRatios):
+    return cumulative_factors(viDates, viSplitDates, 1.0/np.asarray(vnRatios, dtype=np.float64))
+
+'''
+Dividend factors (1 - amount/previous close) for bars with dates viDates and
+closes vnClose. Dividends with no bar before them don't affect any bar.
+'''
+def div_factors(viDates, vnClose, viDivDates, vnAmounts):
+    viPrev = np.searchsorted(viDates, viDivDates, side='left') - 1
+    vbValid = viPrev >= 0
+    vnFactors = np.ones(len(viDivDates))
+    vnFactors[vbValid] = 1.0 - np.asarray(vnAmounts, dtype=np.float64)[vbValid]/vnClose[viPrev[vbValid]]
+    return cumulative_factors(viDates, viDivDates, vnFactors)
+
+'''
+Adjust a date-sorted array of bars with 'date', 'op', 'cl' and 'vol' fields
+(e.g. bar_cache.BAR_DTYPE). Returns a copy.
+'''
+def adjust_bars(bars, splits, divs):
+    viDates = bars['date']
+    vnSplit = split_factors(viDates, splits['date'], splits['ratio'])
+    vnDiv = div_factors(viDates, bars['cl'], divs['date'], divs['amount'])
+    vnPrice = vnSplit*vnDiv
+
+    out = bars.copy()
+    out['op'] = bars['op']*vnPrice
+    out['cl'] = bars['cl']*vnPrice
+    out['vol'] = bars['vol']/vnSplit
+    return out
+
+
+class Adjuster(object):
+
+    def __init__(self, split_fname=split_file, div_fname=div_file):
+        if not split_fname or not div_fname:
+            raise Exception('Local adjustment needs split and dividend files ($SPLIT_FILE, $DIV_FILE)')
+        self.splits = splits_and_divs.get_split_table(split_fname)
+        self.divs = splits_and_divs.get_div_table(div_fname)
+
+    '''
+    Events of a symbol from one of the tables, empty if the symbol has none.
+    '''
+    def events(self, table, symbol, iEnd):
+        if symbol in table:
+            return table.get(symbol, None, iEnd)
+        return dict((name, col[:0]) for name, col in table.columns.items())
+
+    def adjust(self, symbol, bars):
+        if bars.shape[0] == 0:
+            return bars
+        iEnd = int(bars['date'][-1])
+        return adjust_bars(bars, self.events(self.splits, symbol, iEnd), self.events(self.divs, symbol, iEnd))
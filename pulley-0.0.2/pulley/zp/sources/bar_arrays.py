@@ -0,0 +1,112 @@
+'''
+Array helpers shared by the file-backed bar sources (csi, quant_quote).
+
+Loaders produce one part per ticker (or per ticker-day) as compact NumPy arrays:
+    (tkr, vdt, vnPrice, vnVolume)
+where vdt is a time-sorted datetime64 array of naive US/Eastern times. The
+parts are merged into the [dt, sid, price, volume] rows sorted by (dt, sid)
+that redshift.get_price_events expects, either all at once (merge, or
+merge_columns for column arrays) or lazily from per-ticker chunk iterators
+(iter_merge).
+'''
+
+import heapq
+import multiprocessing
+
+import numpy as np
+
+OPEN_OFFSET = np.timedelta64(9*60 + 30, 'm')  # 09:30
+CLOSE_OFFSET = np.timedelta64(16*60, 'm')     # 16:00
+
+'''
+Expand daily bars into open (09:30) and close (16:00) trade events.
+Input vdDates is a datetime64[D] array. Output arrays are interleaved so
+each day's open precedes its close.
+'''
+def daily_events(vdDates, vnOpen, vnClose, vnVolume, include_open=True):
+    vdDates = vdDates.astype('datetime64[m]')
+    vnClose = np.asarray(vnClose)
+    vnVolume = np.asarray(vnVolume)
+    if not include_open:
+        return vdDates + CLOSE_OFFSET, vnClose, vnVolume
+
+    n = vdDates.shape[0]
+    vdt = np.empty(2*n, dtype='datetime64[m]')
+    vdt[0::2] = vdDates + OPEN_OFFSET
+    vdt[1::2] = vdDates + CLOSE_OFFSET
+    vnPrice = np.empty(2*n, dtype=np.result_type(vnOpen, vnClose))
+    vnPrice[0::2] = vnOpen
+    vnPrice[1::2] = vnClose
+    return vdt, vnPrice, np.repeat(vnVolume, 2)
+
+'''
+Merge per-ticker parts into a dict of 'dt', 'sid', 'price' and 'volume'
+arrays sorted by datetime then ticker, which QuerySource reads without
+building row lists. dt stays a datetime64 array and sid is an object array.
+'''
+def merge_columns(parts):
+    parts = [part for part in parts if part[1].shape[0] > 0]
+    if len(parts) == 0:
+        return {'dt': np.zeros(0, dtype='datetime64[us]'),
+                'sid': np.zeros(0, dtype=object),
+                'price': np.zeros(0),
+                'volume': np.zeros(0)}
+
+    # rank tickers alphabetically so ties in dt sort the same way as sorted()
+    vsTkrs = sorted(set(part[0] for part in parts))
+    rank = dict((tkr, i) for i, tkr in enumerate(vsTkrs))
+
+    vdt = np.concatenate([part[1].astype('datetime64[us]') for part in parts])
+    viTkr = np.concatenate([np.repeat(rank[part[0]], part[1].shape[0]) for part in parts])
+    vnPrice = np.concatenate([part[2] for part in parts])
+    vnVolume = np.concatenate([part[3] for part in parts])
+
+    idx = np.lexsort((viTkr, vdt))
+
+    return {'dt': vdt[idx],
+            'sid': np.array(vsTkrs, dtype=object)[viTkr[idx]],
+            'price': vnPrice[idx],
+            'volume': vnVolume[idx]}
+
+'''
+Merge per-ticker parts into a list of [dt, sid, price, volume] rows sorted by
+datetime then ticker, with dt as naive datetime.datetime objects.
+'''
+def merge(parts):
+    columns = merge_columns(parts)
+    return [list(row) for row in zip(columns['dt'].tolist(), columns['sid'].tolist(),
+                                     columns['price'].tolist(), columns['volume'].tolist())]
+
+'''
+Lazily yield (dt, sid, price, volume) rows for one ticker from an iterable of
+time-sorted (vdt, vnPrice, vnVolume) chunks, converting one chunk at a time.
+'''
+def iter_rows(tkr, chunks):
+    for vdt, vnPrice, vnVolume in chunks:
+        for dt, price, vol in zip(vdt.astype('datetime64[us]').tolist(), vnPrice.tolist(), vnVolume.tolist()):
+            yield (dt, tkr, price, vol)
+
+'''
+Streaming k-way merge of per-ticker chunk iterators into rows sorted by
+(dt, sid). streams is a sequence of (tkr, chunks) pairs. Rows come out before
+later chunks are loaded, and memory is bounded by one chunk per ticker.
+'''
+def iter_merge(streams):
+    return heapq.merge(*[iter_rows(tkr, chunks) for tkr, chunks in streams])
+
+'''
+Map func over tasks, in a process pool when processes != 1 (None uses all cores).
+func must be a module-level function so that it can be pickled.
+'''
+def pool_map(func, tasks, processes=1):
+    if processes == 1 or len(tasks) <= 1:
+        return [func(task) for task in tasks]
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        iProcs = processes or multiprocessing.cpu_count()
+        chunksize = max(1, len(tasks) // (4*iProcs))
+        return pool.map(func, tasks, chunksize=chunksize)
+    finally:
+        pool.close()
+        pool.join()
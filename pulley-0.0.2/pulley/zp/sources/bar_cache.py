@@ -0,0 +1,259 @@
+'''
+Incremental on-disk cache of daily bars keyed by (symbol, adjusted).
+
+Each symbol's bars are kept as a date-sorted structured array in
+<cache_dir>/<adj|unadj>/<SYMBOL>.npy, and coverage.json in the same directory
+records the [iBeg, iEnd] (yyyymmdd) range that has already been fetched for
+each symbol. A request only fetches the dates outside that range, appended at
+the end or backfilled at the start, so the covered range stays contiguous.
+
+Adjusted prices are rescaled back through history on every ex-dividend date
+and split, so before adjusted bars are extended the last cached day of each
+symbol is fetched again, and a symbol whose adjusted close has changed is
+dropped and fetched again in full. Unadjusted bars are never refreshed
+implicitly; call invalidate() if history is corrected.
+
+Several caches, in one process or many, can share a directory: coverage is
+read from disk on every request, and bars and coverage are merged and
+written under an exclusive lock on coverage.lock (flock, or msvcrt.locking
+on Windows), with each file written to a temp file and renamed into place.
+
+USAGE:
+
+cache = BarCache('/data/redshift_cache')
+bars = cache.get(['SPY', 'QQQ'], 20100101, 20151231, True, redshift.fetch_daily)
+'''
+
+import os
+import posixpath
+import json
+import contextlib
+from datetime import timedelta
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, lock with msvcrt instead
+    fcntl = None
+    import msvcrt
+
+from pulley.calendar import date_utils
+
+BAR_DTYPE = [('date', 'i8'),
+             ('op', 'f8'),
+             ('cl', 'f8'),
+             ('vol', 'f8')]
+
+COVERAGE_FILE = 'coverage.json'
+ADJUST_TOL = 1e-9   # relative change of a cached adjusted close that means history was re-adjusted
+LOCK_FILE = 'coverage.lock'
+
+'''
+Calendar day after/before an integer yyyymmdd.
+'''
+def next_iDate(iDate):
+    return date_utils.datetime2iDate(date_utils.iDate2Datetime(iDate) + timedelta(days=1))
+
+def prev_iDate(iDate):
+    return date_utils.datetime2iDate(date_utils.iDate2Datetime(iDate) - timedelta(days=1))
+
+'''
+Group a request's missing ranges so that symbols with the same gap share one fetch.
+'''
+def group_ranges(missing):
+    groups = {}
+    for symbol, ranges in missing.items():
+        for rng in ranges:
+            groups.setdefault(rng, []).append(symbol)
+    return groups
+
+
+class BarCache(object):
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def subdir(self, adjusted):
+        return posixpath.join(self.cache_dir, 'adj' if adjusted else 'unadj')
+
+    def path(self, symbol, adjusted):
+        return posixpath.join(self.subdir(adjusted), '%s.npy' % symbol)
+
+    '''
+    Context manager holding an exclusive lock on a subdirectory of the cache:
+
+    with cache.locked(adjusted):
+        coverage = cache.coverage(adjusted)
+    '''
+    @contextlib.contextmanager
+    def locked(self, adjusted):
+        sDir = self.subdir(adjusted)
+        if not os.path.isdir(sDir):
+            try:
+                os.makedirs(sDir)
+            except OSError:
+                # created by another process in the meantime
+                if not os.path.isdir(sDir):
+                    raise
+        with open(posixpath.join(sDir, LOCK_FILE), 'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            else:
+                # locks the first byte, retrying for up to 10 seconds
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+                else:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+    '''
+    Dict of symbol -> covered (iBeg, iEnd), read from disk.
+    '''
+    def coverage(self, adjusted):
+        sPath = posixpath.join(self.subdir(adjusted), COVERAGE_FILE)
+        if not os.path.isfile(sPath):
+            return {}
+        with open(sPath, 'r') as f:
+            return dict((str(k), tuple(v)) for k, v in json.load(f).items())
+
+    '''
+    Write coverage to disk. Call with the lock held, on a dict read under the same lock.
+    '''
+    def save_coverage(self, adjusted, coverage):
+        sPath = posixpath.join(self.subdir(adjusted), COVERAGE_FILE)
+        with open(sPath + '.tmp', 'w') as f:
+            json.dump(coverage, f)
+        os.rename(sPath + '.tmp', sPath)
+
+    def load(self, symbol, adjusted):
+        sPath = self.path(symbol, adjusted)
+        if not os.path.isfile(sPath):
+            return np.zeros(0, dtype=BAR_DTYPE)
+        return np.load(sPath)
+
+    def save(self, symbol, adjusted, bars):
+        sPath = self.path(symbol, adjusted)
+        with open(sPath + '.tmp', 'wb') as f:
+            np.save(f, bars)
+        os.rename(sPath + '.tmp', sPath)
+
+    '''
+    Date ranges in [iBeg, iEnd] that have not been fetched for symbol yet,
+    given the coverage dict.
+    '''
+    def missing(self, symbol, iBeg, iEnd, coverage):
+        covered = coverage.get(symbol)
+        if covered is None:
+            return [(iBeg, iEnd)]
+        ranges = []
+        if iBeg < covered[0]:
+            ranges.append((iBeg, prev_iDate(covered[0])))
+        if iEnd > covered[1]:
+            ranges.append((next_iDate(covered[1]), iEnd))
+        return ranges
+
+    '''
+    Merge newly fetched bars for [iBeg, iEnd] into the cache and the coverage
+    dict. Call with the lock held. Bars for dates already cached are replaced.
+    A head range (ending where the covered range starts) is covered down to
+    iBeg whether or not it returned bars, e.g. before a listing date or over
+    a weekend. Otherwise the covered range grows to include iBeg but only up
+    to the last date actually returned, so days not yet published are asked
+    for again next time. If the symbol's coverage on disk no longer touches
+    the fetched range (it was invalidated and refetched elsewhere in the
+    meantime), the coverage is left alone rather than claiming the gap
+    between them.
+    '''
+    def update(self, symbol, adjusted, bars, iBeg, iEnd, coverage):
+        old = self.load(symbol, adjusted)
+        if bars.shape[0] > 0:
+            old = old[~np.in1d(old['date'], bars['date'])]
+        merged = np.concatenate([old, bars.astype(BAR_DTYPE)])
+        merged = merged[np.argsort(merged['date'], kind='mergesort')]
+        self.save(symbol, adjusted, merged)
+
+        covered = coverage.get(symbol)
+        iLast = int(bars['date'][-1]) if bars.shape[0] > 0 else prev_iDate(iBeg)
+        if covered is None:
+            coverage[symbol] = (iBeg, iLast)
+        elif iBeg < covered[0] and prev_iDate(covered[0]) <= iEnd <= covered[1]:
+            coverage[symbol] = (iBeg, covered[1])
+        elif iBeg <= next_iDate(covered[1]) and iLast >= prev_iDate(covered[0]):
+            coverage[symbol] = (min(covered[0], iBeg), max(covered[1], iLast))
+
+    '''
+    Symbols about to be extended (with missing ranges) whose cached adjusted
+    history is stale: the adjusted close of their last cached day, fetched
+    again, no longer matches the cached one.
+    '''
+    def readjusted(self, symbols, coverage, missing, fetch):
+        groups = {}
+        for symbol in symbols:
+            if symbol not in coverage or not missing[symbol]:
+                continue
+            cached = self.load(symbol, True)
+            if cached.shape[0] > 0:
+                groups.setdefault(int(cached['date'][-1]), []).append((symbol, cached['cl'][-1]))
+
+        stale = []
+        for iLast, group in groups.items():
+            fetched = fetch([symbol for symbol, _ in group], iLast, iLast, True)
+            for symbol, nClose in group:
+                fresh = fetched.get(symbol)
+                if fresh is None or fresh.shape[0] == 0 or abs(fresh['cl'][0]/nClose - 1.0) > ADJUST_TOL:
+                    stale.append(symbol)
+        return stale
+
+    '''
+    Get a dict of symbol -> BAR_DTYPE array with dates in [iBeg, iEnd], calling
+    fetch(symbols, iBeg, iEnd, adjusted) -> {symbol: bars} only for the
+    ranges that are not cached. Fetches run without the lock, so two
+    requests may fetch the same range, and their bars are merged under it.
+    '''
+    def get(self, symbols, iBeg, iEnd, adjusted, fetch):
+        coverage = self.coverage(adjusted)
+        missing = dict((symbol, self.missing(symbol, iBeg, iEnd, coverage)) for symbol in symbols)
+        if adjusted:
+            for symbol in self.readjusted(symbols, coverage, missing, fetch):
+                self.invalidate(symbol, True)
+                missing[symbol] = [(iBeg, iEnd)]
+        groups = group_ranges(missing)
+        for (iLo, iHi), group in groups.items():
+            fetched = fetch(group, iLo, iHi, adjusted)
+            with self.locked(adjusted):
+                coverage = self.coverage(adjusted)
+                for symbol in group:
+                    bars = fetched.get(symbol, np.zeros(0, dtype=BAR_DTYPE))
+                    self.update(symbol, adjusted, bars, iLo, iHi, coverage)
+                self.save_coverage(adjusted, coverage)
+
+        out = {}
+        for symbol in symbols:
+            bars = self.load(symbol, adjusted)
+            iLo, iHi = np.searchsorted(bars['date'], [iBeg, iEnd + 1])
+            out[symbol] = bars[iLo:iHi]
+        return out
+
+    '''
+    Drop cached bars. With no arguments the whole cache is cleared; symbol
+    and/or adjusted restrict what is dropped.
+    '''
+    def invalidate(self, symbol=None, adjusted=None):
+        for adj in ([True, False] if adjusted is None else [adjusted]):
+            if not os.path.isdir(self.subdir(adj)):
+                continue
+            with self.locked(adj):
+                coverage = self.coverage(adj)
+                symbols = list(coverage.keys()) if symbol is None else [symbol]
+                for sym in symbols:
+                    coverage.pop(sym, None)
+                    if os.path.isfile(self.path(sym, adj)):
+                        os.remove(self.path(sym, adj))
+                self.save_coverage(adj, coverage)
@@ -0,0 +1,103 @@
+'''
+Locally stored benchmark (SPY) close series for Zipline benchmark sources.
+
+The closes live in a BarCache, so only days after the cached range are
+fetched, and at most once per process for a given end date. When a new
+dividend has rescaled the adjusted closes the BarCache refetches the whole
+history. Returns are computed with vectorized operations, and any
+[tBeg, tEnd] window is served with searchsorted without a database
+round-trip.
+
+USAGE:
+
+store = BenchmarkStore(cache_dir, redshift.fetch_daily)
+bench_source, bench_price_utc = store.source(tBeg, tEnd)
+'''
+
+import numpy as np
+import pandas as pd
+
+from zipline.protocol import DATASOURCE_TYPE
+
+from pulley.calendar import date_utils
+from pulley.zp.sources.bar_cache import BarCache
+
+BENCH_SYMBOL = 'SPY'
+BENCH_START = 19930101 # SPY listed in January 1993
+CLOSE_HOUR = 16
+
+'''
+Simple (not log) returns of a price array. The first element has no previous
+price and is set to 0.0.
+'''
+def simple_returns(vnPrice):
+    vnReturns = np.zeros(vnPrice.shape[0])
+    vnReturns[1:] = vnPrice[1:]/vnPrice[:-1] - 1.0
+    return vnReturns
+
+'''
+Convert integer yyyymmdd dates to tz-aware UTC timestamps of the US/Eastern close.
+'''
+def close_times_utc(viDates):
+    vdt = date_utils.iDate2datetime64(viDates).astype('datetime64[ns]') + np.timedelta64(CLOSE_HOUR, 'h')
+    return pd.DatetimeIndex(vdt).tz_localize('US/Eastern').tz_convert('UTC')
+
+
+class BenchmarkStore(object):
+
+    def __init__(self, cache_dir, fetch, symbol=BENCH_SYMBOL, adjusted=True):
+        self.cache = BarCache(cache_dir)
+        self.fetch = fetch
+        self.symbol = symbol
+        self.adjusted = adjusted
+        self.refreshed_to = None
+
+        self.viDates = np.zeros(0, dtype=np.int64)
+        self.vnClose = np.zeros(0)
+        self.vnReturns = np.zeros(0)
+        self.index_utc = pd.DatetimeIndex([], tz='UTC')
+
+    '''
+    Bring the series up to iEnd (yyyymmdd, default today), fetching only new days.
+    '''
+    def refresh(self, iEnd=None):
+        if iEnd is None:
+            iEnd = date_utils.iDateNow()
+        if self.refreshed_to is not None and iEnd <= self.refreshed_to:
+            return
+
+        bars = self.cache.get([self.symbol], BENCH_START, iEnd, self.adjusted, self.fetch)[self.symbol]
+        self.viDates = bars['date']
+        self.vnClose = bars['cl']
+        self.vnReturns = simple_returns(self.vnClose)
+        self.index_utc = close_times_utc(self.viDates)
+        self.refreshed_to = iEnd
+
+    '''
+    Daily returns over the whole history, indexed by UTC midnight of each date
+    (same as redshift.get_bench_returns).
+    '''
+    def returns(self):
+        self.refresh()
+        index = pd.DatetimeIndex(date_utils.iDate2datetime64(self.viDates[1:])).tz_localize('UTC')
+        return pd.Series(self.vnReturns[1:], index=index)
+
+    '''
+    Get the benchmark event list and the UTC-indexed close series for
+    [tBeg, tEnd]. The first return in the window uses the close before tBeg.
+    '''
+    def source(self, tBeg, tEnd):
+        self.refresh(date_utils.datetime2iDate(tEnd))
+
+        iLo, iHi = np.searchsorted(self.viDates, [date_utils.datetime2iDate(tBeg),
+                                                  date_utils.datetime2iDate(tEnd) + 1])
+        index_utc = self.index_utc[iLo:iHi]
+        bench_price_utc = pd.Series(self.vnClose[iLo:iHi], index=index_utc)
+
+        bench_source = [{'dt': dt,
+                         'returns': ret,
+                         'type': DATASOURCE_TYPE.BENCHMARK,
+                         'source_id': 'ga_benchmark'}
+                        for dt, ret in zip(index_utc, self.vnReturns[iLo:iHi].tolist())]
+
+        return bench_source, bench_price_utc
@@ -0,0 +1,135 @@
+'''
+Symbol-indexed columnar store of memory-mapped NumPy arrays.
+
+A store is a directory holding one raw binary file per column, a
+'symbols.npy' array, an 'offsets.npy' array and a 'meta.json' describing the
+column dtypes. Rows for symbols[i] live in [offsets[i], offsets[i+1]) of every
+column and are sorted by the integer yyyymmdd 'date' column, so a date range
+is sliced out of a symbol's block with searchsorted.
+
+USAGE:
+
+writer = ColumnStoreWriter(path, [('date', 'i8'), ('cl', 'f4')])
+writer.append('SPY', {'date': viDates, 'cl': vnClose})
+writer.close()
+
+store = ColumnStore(path)
+cols = store.get('SPY', 20100101, 20141231)
+'''
+
+import os
+import posixpath
+import json
+
+import numpy as np
+
+DATE_COL = 'date'
+META_FILE = 'meta.json'
+SYMBOLS_FILE = 'symbols.npy'
+OFFSETS_FILE = 'offsets.npy'
+
+'''
+Returns true if path holds a completely written store.
+'''
+def is_store(path):
+    return os.path.isfile(posixpath.join(path, META_FILE))
+
+
+class ColumnStoreWriter(object):
+
+    def __init__(self, path, dtypes):
+        if DATE_COL not in [name for name, _ in dtypes]:
+            raise Exception('Store columns must include a %s column' % DATE_COL)
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        # meta.json is written last, so remove it first to mark the store incomplete
+        if is_store(path):
+            os.remove(posixpath.join(path, META_FILE))
+
+        self.path = path
+        self.dtypes = [(name, np.dtype(dtype)) for name, dtype in dtypes]
+        self.symbols = []
+        self.offsets = [0]
+        self.files = {}
+        for name, _ in self.dtypes:
+            self.files[name] = open(posixpath.join(path, '%s.bin' % name), 'wb')
+
+    def append(self, symbol, columns):
+        if symbol in self.symbols:
+            raise Exception('Symbol already written to store: %s' % symbol)
+
+        idx = np.argsort(np.asarray(columns[DATE_COL]), kind='mergesort')
+        for name, dtype in self.dtypes:
+            np.asarray(columns[name], dtype=dtype)[idx].tofile(self.files[name])
+
+        self.symbols.append(symbol)
+        self.offsets.append(self.offsets[-1] + len(idx))
+
+    '''
+    Finish the store. Keys of extra are written to meta.json alongside the
+    column layout and come back as ColumnStore.meta.
+    '''
+    def close(self, extra=None):
+        for f in self.files.values():
+            f.close()
+
+        np.save(posixpath.join(self.path, SYMBOLS_FILE), np.array(self.symbols, dtype=str))
+        np.save(posixpath.join(self.path, OFFSETS_FILE), np.array(self.offsets, dtype=np.int64))
+
+        meta = {'nrows': self.offsets[-1],
+                'columns': [[name, dtype.str] for name, dtype in self.dtypes]}
+        if extra is not None:
+            meta.update(extra)
+        with open(posixpath.join(self.path, META_FILE), 'w') as f:
+            json.dump(meta, f)
+
+
+class ColumnStore(object):
+
+    def __init__(self, path):
+        if not is_store(path):
+            raise Exception('No column store found in %s' % path)
+
+        with open(posixpath.join(path, META_FILE), 'r') as f:
+            meta = json.load(f)
+
+        self.path = path
+        self.meta = meta
+        self.nrows = int(meta['nrows'])
+        self.symbols = np.load(posixpath.join(path, SYMBOLS_FILE))
+        self.offsets = np.load(posixpath.join(path, OFFSETS_FILE))
+        self.index = dict((str(sym), i) for i, sym in enumerate(self.symbols))
+
+        self.columns = {}
+        for name, dtype in meta['columns']:
+            if self.nrows == 0:
+                # np.memmap refuses zero length files
+                self.columns[str(name)] = np.zeros(0, dtype=dtype)
+            else:
+                self.columns[str(name)] = np.memmap(posixpath.join(path, '%s.bin' % name),
+                                                    dtype=dtype, mode='r', shape=(self.nrows,))
+
+    def __contains__(self, symbol):
+        return symbol in self.index
+
+    '''
+    Get a dict of column arrays for symbol with dates in [iBeg, iEnd] (yyyymmdd).
+    Arrays are read-only views into the memory map.
+    '''
+    def get(self, symbol, iBeg=None, iEnd=None):
+        i = self.index[symbol]
+        iLo = self.offsets[i]
+        iHi = self.offsets[i+1]
+
+        viDates = self.columns[DATE_COL][iLo:iHi]
+        if iBeg is not None:
+            iLo += np.searchsorted(viDates, iBeg, side='left')
+        if iEnd is not None:
+            iHi = self.offsets[i] + np.searchsorted(viDates, iEnd, side='right')
+
+        out = {}
+        for name, col in self.columns.items():
+            out[name] = col[iLo:iHi]
+        return out
@@ -1,12 +1,13 @@
 import os
 import posixpath
-import datetime
-import operator
-import glob
 import numpy as np
 from pulley.calendar import date_utils
+from pulley.zp.sources.column_store import ColumnStore, ColumnStoreWriter, is_store
+from pulley.zp.sources.manifest import FileManifest, csi_ticker
+from pulley.zp.sources import bar_arrays
 
 csi_home = os.getenv('CSI_HOME', '')
+csi_store_home = os.getenv('CSI_STORE_HOME', csi_home)
 
 DTYPE = [('symu', 'S30'),
          ('exchange', 'S30'),
@@ -17,48 +18,166 @@ DTYPE = [('symu', 'S30'),
          ('cl', 'f'),
          ('vol', 'f')]
 
+# columns of the binary bar store built by ingest()
+STORE_DTYPE = [('date', 'i8'),
+               ('op', 'f4'),
+               ('hi', 'f4'),
+               ('lo', 'f4'),
+               ('cl', 'f4'),
+               ('vol', 'f4')]
+
+'''
+Directory of the binary bar store for a CSI portfolio.
+'''
+def store_path(portfolio='ETFs', store_dir=None):
+    if store_dir is None:
+        store_dir = csi_store_home
+    return posixpath.join(store_dir, '%s.store' % portfolio)
+
+'''
+Ticker -> CSV file manifest for a CSI portfolio, cached next to the portfolio directory.
+'''
+def get_manifest(portfolio='ETFs'):
+    return FileManifest([posixpath.join(csi_home, portfolio)], '*.CSV', csi_ticker)
+
+'''
+Conversion of the raw $CSI_HOME/<portfolio>/*.CSV files into a binary
+columnar store that get_data memory-maps instead of parsing text. The size
+and mtime of each ticker's CSV file are recorded in the store, and tickers
+whose file has changed since are read from the CSV files until the next
+ingest.
+'''
+def ingest(portfolio='ETFs', store_dir=None):
+
+    manifest = get_manifest(portfolio)
+    vsFiles = sorted(manifest[tkr]['path'] for tkr in manifest.keys())
+    if len(vsFiles) == 0:
+        raise Exception('No CSV files found in %s' % posixpath.join(csi_home, portfolio))
+
+    sStore = store_path(portfolio, store_dir)
+    writer = ColumnStoreWriter(sStore, STORE_DTYPE)
+
+    sources = {}
+    for csvPath in vsFiles:
+        # stat before reading, so a file changed while being read looks stale
+        st = os.stat(csvPath)
+        bars = np.atleast_1d(np.genfromtxt(csvPath, delimiter=',', skip_header=False, dtype=DTYPE))
+        if bars.shape[0] == 0:
+            continue
+        viDates = np.char.replace(bars['date'], '-', '').astype(np.int64)
+        writer.append(bars['symu'][0], {'date': viDates,
+                                        'op': bars['op'],
+                                        'hi': bars['hi'],
+                                        'lo': bars['lo'],
+                                        'cl': bars['cl'],
+                                        'vol': bars['vol']})
+        sources[bars['symu'][0]] = {'path': csvPath, 'size': st.st_size, 'mtime': st.st_mtime}
+    writer.close(extra={'sources': sources})
+    return sStore
+
+'''
+Open the portfolio's store if ingest() has built one that is current for all
+of tickers: each ticker is in the store and its CSV file still has the size
+and mtime recorded at ingest. A CSV file that no longer exists doesn't make
+the store stale, the store is then the only copy. Returns None otherwise,
+so the CSV files are read instead.
+'''
+def get_store(tickers, portfolio='ETFs', store_dir=None):
+    sStore = store_path(portfolio, store_dir)
+    if not is_store(sStore):
+        return None
+    store = ColumnStore(sStore)
+    sources = store.meta.get('sources')
+    if sources is None:
+        # built before ingest recorded its source files
+        return None
+    for tkr in tickers:
+        if tkr not in store or tkr not in sources:
+            return None
+        source = sources[tkr]
+        if os.path.isfile(source['path']):
+            st = os.stat(source['path'])
+            if st.st_size != source['size'] or st.st_mtime != source['mtime']:
+                return None
+    return store
+
 """
 Import list of CSI prices from raw CSV files. Files must be of the format
      TICKER, EXCHANGE, DATE (yyyy-mm-dd), OPEN, HIGH, LOW, CLOSE, VOLUME
-For use with Zipline.
+For use with Zipline. If a store built by ingest() is current for the tickers
+(see get_store) it is memory-mapped and the CSV files are not read. Otherwise, with
+processes != 1 the CSV files are parsed in a process pool (None uses all cores).
+With stream=True a generator is returned instead that merges the tickers lazily,
+and with columnar=True a dict of column arrays (see bar_arrays.merge_columns).
 """
-def get_data(tickers, tBeg, tEnd, include_open=True, portfolio='ETFs'):
+def get_data(tickers, tBeg, tEnd, include_open=True, portfolio='ETFs', store_dir=None, processes=1,
+             stream=False, columnar=False):
 
-    iBeg = date_utils.datetime2iDate(tBeg)
-    iEnd = date_utils.datetime2iDate(tEnd)
-    trading_dates = date_utils.nyseDates(iBeg, iEnd)
+    if stream:
+        store = get_store(tickers, portfolio, store_dir)
+        if store is not None:
+            return bar_arrays.iter_merge([(tkr, iter_chunks(tkr, tBeg, tEnd, include_open, store=store))
+                                          for tkr in tickers])
+        manifest = get_manifest(portfolio)
+        for tkr in tickers:
+            manifest.path(tkr)
+        return bar_arrays.iter_merge([(tkr, iter_chunks(tkr, tBeg, tEnd, include_open, manifest=manifest))
+                                      for tkr in tickers])
 
-    sPortDir = posixpath.join(csi_home, portfolio)
-    vsFiles = glob.glob(posixpath.join(sPortDir, '*.CSV'))
+    parts = get_arrays(tickers, tBeg, tEnd, include_open=include_open, portfolio=portfolio,
+                       store_dir=store_dir, processes=processes)
+    if columnar:
+        return bar_arrays.merge_columns(parts)
+    return bar_arrays.merge(parts)
 
-    output = []
-    
-    for tkr in tickers:
-        idxFile = []
-        for i, sFile in enumerate(vsFiles):
-            if '%s_' % tkr in sFile:
-                idxFile.append(i)
-        if len(idxFile) == 0:
-            raise Exception('Cannot find file for ticker: %s (looking in %s)' % (tkr, sPortDir))
-        if len(idxFile) > 1:
-            raise Exception('Multiple files found for ticker: %s' % tkr)
-
-        csvPath = vsFiles[idxFile[0]]
-
-        bars = np.genfromtxt(csvPath, delimiter=',', skip_header=False, dtype=DTYPE)
-
-        for bar in bars:
-            tkr = bar[0]
-            sDate = bar[2]
-            nOpen = bar[3]
-            nClose = bar[6]
-            nVolume = bar[7]
-
-            dt = datetime.datetime.strptime(sDate, '%Y-%m-%d')
-
-            if dt.date() >= tBeg.date() and dt.date() <= tEnd.date():
-                if include_open:
-                    output.append([dt.replace(hour=9, minute=30), tkr, nOpen, nVolume])
-                output.append([dt.replace(hour=16, minute=0), tkr, nClose, nVolume])
-                
-    return sorted(output, key=operator.itemgetter(0,1))
+'''
+Get open (09:30) and close (16:00) events for tickers in [tBeg, tEnd] as one
+(tkr, vdt, vnPrice, vnVolume) tuple of time-sorted arrays per ticker.
+'''
+def get_arrays(tickers, tBeg, tEnd, include_open=True, portfolio='ETFs', store_dir=None, processes=1):
+
+    store = get_store(tickers, portfolio, store_dir)
+    if store is not None:
+        iBeg = date_utils.datetime2iDate(tBeg)
+        iEnd = date_utils.datetime2iDate(tEnd)
+        return [(tkr,) + store_events(store, tkr, iBeg, iEnd, include_open) for tkr in tickers]
+
+    manifest = get_manifest(portfolio)
+    tasks = [(tkr, manifest.path(tkr), tBeg.date(), tEnd.date(), include_open) for tkr in tickers]
+    return bar_arrays.pool_map(load_csv, tasks, processes)
+
+'''
+Parse one ticker's CSV into open/close event arrays restricted to [dBeg, dEnd].
+The date column is parsed once into datetime64[D] and filtered with a mask.
+Also the process pool worker for get_arrays.
+'''
+def load_csv(task):
+    tkr, csvPath, dBeg, dEnd, include_open = task
+    bars = np.atleast_1d(np.genfromtxt(csvPath, delimiter=',', skip_header=False, dtype=DTYPE))
+    vdDates = bars['date'].astype('datetime64[D]')
+    mask = (vdDates >= np.datetime64(dBeg)) & (vdDates <= np.datetime64(dEnd))
+    bars = bars[mask]
+    vdt, vnPrice, vnVolume = bar_arrays.daily_events(vdDates[mask], bars['op'], bars['cl'], bars['vol'],
+                                                     include_open=include_open)
+    return tkr, vdt, vnPrice, vnVolume
+
+'''
+Open/close event arrays for one ticker with dates in [iBeg, iEnd] (yyyymmdd),
+sliced from a memory-mapped ColumnStore with searchsorted.
+'''
+def store_events(store, tkr, iBeg, iEnd, include_open=True):
+    cols = store.get(tkr, iBeg, iEnd)
+    return bar_arrays.daily_events(date_utils.iDate2datetime64(cols['date']), cols['op'], cols['cl'],
+                                   cols['vol'], include_open=include_open)
+
+'''
+Lazily yield a ticker's open/close event arrays as a single chunk, slicing the
+store or parsing the CSV file only when the merge first asks for it.
+'''
+def iter_chunks(tkr, tBeg, tEnd, include_open=True, manifest=None, store=None):
+    if store is not None:
+        yield store_events(store, tkr, date_utils.datetime2iDate(tBeg), date_utils.datetime2iDate(tEnd),
+                           include_open)
+    else:
+        _, vdt, vnPrice, vnVolume = load_csv((tkr, manifest.path(tkr), tBeg.date(), tEnd.date(), include_open))
+        yield vdt, vnPrice, vnVolume
@@ -0,0 +1,159 @@
+'''
+Persistent map of ticker -> data file for file-backed bar sources.
+
+The manifest records the path, size and mtime of every file matching a glob
+pattern in a set of directories, keyed by the exact ticker parsed from the
+file name. It is cached on disk as JSON together with the mtime of each
+directory, and only directories whose mtime has changed are rescanned.
+A ticker matched by several files only raises when its path is asked for.
+
+USAGE:
+
+manifest = FileManifest(['/data/csi/ETFs'], '*.CSV', csi_ticker)
+csvPath = manifest.path('SPY')
+'''
+
+import os
+import posixpath
+import glob
+import json
+
+'''
+Ticker of a CSI file name of the form TICKER_<suffix>.CSV.
+'''
+def csi_ticker(directory, fname):
+    return posixpath.splitext(fname)[0].rsplit('_', 1)[0]
+
+'''
+Ticker of a QuantQuote file name of the form table_<ticker>.csv.
+'''
+def quant_quote_ticker(directory, fname):
+    return posixpath.splitext(fname)[0][len('table_'):].upper()
+
+
+class FileManifest(object):
+
+    def __init__(self, directories, pattern, key_func, cache_path=None):
+        if isinstance(directories, basestring):
+            directories = [directories]
+        if cache_path is None:
+            if len(directories) != 1:
+                raise Exception('cache_path is required for a manifest of several directories')
+            # keep the cache outside the scanned directory so writing it doesn't change its mtime
+            cache_path = directories[0].rstrip('/') + '.manifest.json'
+
+        self.directories = list(directories)
+        self.pattern = pattern
+        self.key_func = key_func
+        self.cache_path = cache_path
+
+        self.dir_mtimes = {}
+        self.dir_files = {}
+        self.files = {}
+        self.conflicts = {}
+        self.load()
+        self.update()
+
+    def __contains__(self, key):
+        return key in self.files
+
+    def __getitem__(self, key):
+        return self.files[key]
+
+    '''
+    Tickers with exactly one file. Tickers with several are left out, see path.
+    '''
+    def keys(self):
+        return self.files.keys()
+
+    '''
+    Path of the file for a ticker. Raises if the ticker has no file or
+    several files match it.
+    '''
+    def path(self, key):
+        if key in self.conflicts:
+            raise Exception('Multiple files found for ticker: %s (%s)' % \
+                                (key, ', '.join(self.conflicts[key])))
+        if key not in self.files:
+            raise Exception('Cannot find file for ticker: %s (looking in %s)' % \
+                                (key, ', '.join(self.directories)))
+        return self.files[key]['path']
+
+    def load(self):
+        if not os.path.isfile(self.cache_path):
+            return
+        try:
+            with open(self.cache_path, 'r') as f:
+                cache = json.load(f)
+        except ValueError:
+            # corrupt cache, rebuild from scratch
+            return
+        if cache.get('pattern') != self.pattern:
+            return
+        for directory in self.directories:
+            entry = cache['dirs'].get(directory)
+            # caches written before conflicts were kept have no per-directory files
+            if entry is None or 'files' not in entry:
+                continue
+            self.dir_mtimes[directory] = entry['mtime']
+            self.dir_files[directory] = entry['files']
+        self.merge()
+
+    def save(self):
+        cache = {'pattern': self.pattern, 'dirs': {}}
+        for directory in self.directories:
+            cache['dirs'][directory] = {'mtime': self.dir_mtimes[directory],
+                                        'files': self.dir_files[directory]}
+        sTmp = self.cache_path + '.tmp'
+        try:
+            with open(sTmp, 'w') as f:
+                json.dump(cache, f)
+            os.rename(sTmp, self.cache_path)
+        except (IOError, OSError):
+            # read-only location, the manifest still works in memory
+            pass
+
+    '''
+    Rescan directories whose mtime changed since the manifest was cached.
+    Pass force=True to rescan everything.
+    '''
+    def update(self, force=False):
+        changed = False
+        for directory in self.directories:
+            mtime = os.stat(directory).st_mtime
+            if not force and self.dir_mtimes.get(directory) == mtime:
+                continue
+            self.scan(directory)
+            self.dir_mtimes[directory] = mtime
+            changed = True
+        if changed:
+            self.merge()
+            self.save()
+
+    '''
+    Record every file of a directory as ticker -> list of file entries.
+    '''
+    def scan(self, directory):
+        files = {}
+        for sFile in sorted(glob.glob(posixpath.join(directory, self.pattern))):
+            key = self.key_func(directory, posixpath.basename(sFile))
+            st = os.stat(sFile)
+            files.setdefault(key, []).append({'path': sFile, 'size': st.st_size, 'mtime': st.st_mtime})
+        self.dir_files[directory] = files
+
+    '''
+    Combine the directories' files into files (tickers with one file) and
+    conflicts (ticker -> paths of tickers with several).
+    '''
+    def merge(self):
+        entries = {}
+        for directory in self.directories:
+            for key, dir_entries in self.dir_files.get(directory, {}).items():
+                entries.setdefault(key, []).extend(dir_entries)
+        self.files = {}
+        self.conflicts = {}
+        for key, key_entries in entries.items():
+            if len(key_entries) == 1:
+                self.files[key] = key_entries[0]
+            else:
+                self.conflicts[key] = [entry['path'] for entry in key_entries]
@@ -1,13 +1,16 @@
 import os
 import posixpath
 import datetime
-import operator
 
 import numpy as np
+import pandas as pd
 
-from pulley.calendar import date_utils
+from pulley.calendar import date_utils, minute_grid
+from pulley.zp.sources import bar_arrays, quant_quote_pack
+from pulley.zp.sources.manifest import FileManifest, quant_quote_ticker
 
 quant_quote_home = os.getenv('QUANT_QUOTE_HOME', '')
+quant_quote_pack_home = os.getenv('QUANT_QUOTE_PACK_HOME', '')
 
 DTYPE = [('date', 'i'),
          ('time', 'i'),
@@ -27,30 +30,168 @@ def make_datetime(iDate, iTime):
     dt = date_utils.iDate2Datetime(iDate)
     return dt.replace(hour=iHour, minute=iMinute, second=0, microsecond=0, tzinfo=None)
 
-def get_data(tickers, tBeg, tEnd, base_dir=quant_quote_home, crop=True):
+'''
+Read a whole table_<tkr>.csv and keep the bars with time in [931, 1600].
+Returns the structured bars and their datetime64[m] timestamps, computed for
+all rows at once from the date and time columns.
+'''
+def read_table(fname):
+    frame = pd.read_csv(fname, header=None, names=[name for name, _ in DTYPE])
+    bars = np.empty(frame.shape[0], dtype=DTYPE)
+    for name, _ in DTYPE:
+        bars[name] = frame[name].values
+
+    bars = bars[(bars['time'] >= 931) & (bars['time'] <= 1600)]
+    vnMinutes = (bars['time'] // 100)*60 + bars['time'] % 100
+    vdt = date_utils.iDate2datetime64(bars['date']).astype('datetime64[m]') + \
+        vnMinutes.astype('timedelta64[m]')
+    return bars, vdt
+
+'''
+Parse one table_<tkr>.csv for one day into arrays of close prices and volumes.
+Process pool worker for get_arrays, so it returns arrays rather than rows.
+'''
+def load_day(task):
+    tkr, fname, iDate = task
+    bars, vdt = read_table(fname)
+    return tkr, vdt, bars['cl'], bars['vol']
+
+'''
+Parse all of one ticker's daily files in [iBeg, iEnd] and write them as a
+compressed monthly pack. Process pool worker for repack.
+'''
+def repack_ticker(task):
+    tkr, base_dir, pack_dir, iBeg, iEnd = task
+    chunks = []
+    for date in date_utils.nyseDates(iBeg, iEnd):
+        fname = posixpath.join(base_dir, 'allstocks_%i' % date, 'table_%s.csv' % tkr.lower())
+        if not os.path.isfile(fname):
+            continue
+        bars, vdt = read_table(fname)
+        chunk = np.empty(bars.shape[0], dtype=quant_quote_pack.BAR_DTYPE)
+        chunk['dt'] = vdt
+        for name in ('op', 'hi', 'lo', 'cl', 'vol'):
+            chunk[name] = bars[name]
+        chunks.append(chunk)
+    if len(chunks) == 0:
+        return tkr, 0
+    bars = np.concatenate(chunks)
+    quant_quote_pack.write_pack(pack_dir, tkr, bars, iBeg, iEnd)
+    return tkr, bars.shape[0]
+
+'''
+Repack the allstocks_YYYYMMDD/table_<tkr>.csv layout in [tBeg, tEnd] into
+per-ticker, per-month compressed chunks in pack_dir, which get_data then reads
+instead of opening one file per ticker per day. The days are merged into a
+ticker's existing pack, so it can be extended one day at a time. If tickers
+is None every ticker in the last day's directory on disk is repacked. Days
+missing for a ticker are skipped. Returns a dict of bars written per ticker.
+'''
+def repack(tickers, tBeg, tEnd, base_dir=quant_quote_home, pack_dir=quant_quote_pack_home, processes=1):
 
     iBeg = date_utils.datetime2iDate(tBeg)
     iEnd = date_utils.datetime2iDate(tEnd)
-    trading_dates = date_utils.nyseDates(iBeg, iEnd)
 
-    output = []
+    if tickers is None:
+        vsDirs = [posixpath.join(base_dir, 'allstocks_%i' % date) for date in date_utils.nyseDates(iBeg, iEnd)]
+        vsDirs = [sDir for sDir in vsDirs if os.path.isdir(sDir)]
+        if len(vsDirs) == 0:
+            raise Exception('No QuantQuote directories found in %s' % base_dir)
+        manifest = FileManifest([vsDirs[-1]], 'table_*.csv', quant_quote_ticker,
+                                cache_path=posixpath.join(pack_dir, 'tickers.manifest.json'))
+        tickers = sorted(manifest.keys())
 
+    tasks = [(tkr, base_dir, pack_dir, iBeg, iEnd) for tkr in tickers]
+    return dict(bar_arrays.pool_map(repack_ticker, tasks, processes))
+
+'''
+Get minute bars for tickers in [tBeg, tEnd] as one (tkr, vdt, vnPrice, vnVolume)
+tuple of time-sorted arrays per ticker. Bars are read from pack_dir when every
+ticker's pack covers [tBeg, tEnd], and otherwise from the QuantQuote daily
+directories. With processes != 1 the ticker-day files are parsed in a process
+pool (None uses all cores).
+'''
+def get_arrays(tickers, tBeg, tEnd, base_dir=quant_quote_home, processes=1, pack_dir=quant_quote_pack_home):
+
+    iBeg = date_utils.datetime2iDate(tBeg)
+    iEnd = date_utils.datetime2iDate(tEnd)
+
+    if quant_quote_pack.has_pack(pack_dir, tickers, iBeg, iEnd):
+        parts = []
+        for tkr in tickers:
+            bars = quant_quote_pack.read_pack(pack_dir, tkr, iBeg, iEnd)
+            parts.append((tkr, bars['dt'], bars['cl'], bars['vol']))
+        return parts
+
+    trading_dates = date_utils.nyseDates(iBeg, iEnd)
+
+    tasks = []
     for tkr in tickers:
-        tkr_lower = tkr.lower()
-        tkr_upper = tkr.upper()
         for date in trading_dates:
-            fname = posixpath.join(base_dir, 'allstocks_%i' % date, 'table_%s.csv' % tkr_lower)
-            bars = np.genfromtxt(fname, delimiter=',', skip_header=False, dtype=DTYPE)
-            bars = bars[(bars['time'] >= 931) & (bars['time'] <= 1600)]
-
-            # if bars.shape[0] != 390:
-            #     print 'Number of bars != 390: %s on %i has %i bars. [%s, %s]' % \
-            #               (tkr_upper, date, bars.shape[0], bars['time'][0], bars['time'][-1])
-            
-            for bar in bars:
-                dt = make_datetime(bar[0], bar[1])
-                output.append([dt, tkr, bar[5], bar[6]])
-                
-    # sort by datetime then ticker for use with Zipline       
-    return sorted(output, key=operator.itemgetter(0,1))
+            fname = posixpath.join(base_dir, 'allstocks_%i' % date, 'table_%s.csv' % tkr.lower())
+            tasks.append((tkr, fname, date))
+    days = bar_arrays.pool_map(load_day, tasks, processes)
+
+    parts = []
+    for i, tkr in enumerate(tickers):
+        tkr_days = days[i*len(trading_dates):(i+1)*len(trading_dates)]
+        if len(tkr_days) == 0:
+            continue
+        parts.append((tkr,
+                      np.concatenate([day[1] for day in tkr_days]),
+                      np.concatenate([day[2] for day in tkr_days]),
+                      np.concatenate([day[3] for day in tkr_days])))
+    return parts
+
+'''
+Lazily yield one ticker's (vdt, vnPrice, vnVolume) chunks, one day file or one
+packed month at a time. The pack is used when it covers [iBeg, iEnd].
+'''
+def iter_chunks(tkr, iBeg, iEnd, base_dir=quant_quote_home, pack_dir=quant_quote_pack_home):
+    if quant_quote_pack.has_pack(pack_dir, [tkr], iBeg, iEnd):
+        for bars in quant_quote_pack.iter_pack(pack_dir, tkr, iBeg, iEnd):
+            yield bars['dt'], bars['cl'], bars['vol']
+    else:
+        for date in date_utils.nyseDates(iBeg, iEnd):
+            fname = posixpath.join(base_dir, 'allstocks_%i' % date, 'table_%s.csv' % tkr.lower())
+            _, vdt, vnPrice, vnVolume = load_day((tkr, fname, date))
+            yield vdt, vnPrice, vnVolume
+
+'''
+Get minute bars as [dt, sid, price, volume] rows sorted by datetime then ticker
+for use with Zipline. With stream=True a generator is returned instead that
+merges the tickers lazily, holding at most one chunk per ticker in memory
+(processes is ignored). With columnar=True a dict of column arrays is returned
+instead of rows, see bar_arrays.merge_columns.
+'''
+def get_data(tickers, tBeg, tEnd, base_dir=quant_quote_home, crop=True, processes=1,
+             pack_dir=quant_quote_pack_home, stream=False, columnar=False):
+    if stream:
+        iBeg = date_utils.datetime2iDate(tBeg)
+        iEnd = date_utils.datetime2iDate(tEnd)
+        return bar_arrays.iter_merge([(tkr, iter_chunks(tkr, iBeg, iEnd, base_dir=base_dir, pack_dir=pack_dir))
+                                      for tkr in tickers])
+    parts = get_arrays(tickers, tBeg, tEnd, base_dir=base_dir, processes=processes, pack_dir=pack_dir)
+    if columnar:
+        return bar_arrays.merge_columns(parts)
+    return bar_arrays.merge(parts)
+
+'''
+Get minute bars aligned on the dense session-minute grid of [tBeg, tEnd]:
+returns (vdt, mnPrice, mnVolume) with one row per session minute and one
+column per ticker. Closes are float32 and, with fill=True, forward-filled
+over minutes without a bar; volumes are zero there.
+'''
+def get_matrix(tickers, tBeg, tEnd, base_dir=quant_quote_home, processes=1, pack_dir=quant_quote_pack_home,
+               fill=True):
+    grid = minute_grid.get_grid(date_utils.datetime2iDate(tBeg), date_utils.datetime2iDate(tEnd))
+    parts = dict((part[0], part[1:]) for part in
+                 get_arrays(tickers, tBeg, tEnd, base_dir=base_dir, processes=processes, pack_dir=pack_dir))
 
+    empty = (np.zeros(0, dtype='datetime64[m]'), np.zeros(0), np.zeros(0))
+    vdts = [parts.get(tkr, empty)[0] for tkr in tickers]
+    mnPrice = grid.scatter(vdts, [parts.get(tkr, empty)[1] for tkr in tickers])
+    mnVolume = grid.scatter(vdts, [parts.get(tkr, empty)[2] for tkr in tickers], fill=0.0)
+    if fill:
+        mnPrice = minute_grid.ffill(mnPrice)
+    return grid.datetimes(), mnPrice, mnVolume
@@ -0,0 +1,203 @@
+'''
+Date-partitioned, compressed binary packs of QuantQuote minute bars.
+
+Each ticker has three files in the pack directory:
+    <TKR>.bin         zlib-compressed chunks of BAR_DTYPE records, one per month
+    <TKR>.idx.npy     chunk index of INDEX_DTYPE records sorted by month
+    <TKR>.cover.json  [iBeg, iEnd] (yyyymmdd) day ranges that have been packed
+so a reader opens one file per ticker and decompresses only the months that
+overlap the requested range. Packs are written by quant_quote.repack, which
+merges newly packed days into the existing pack, and reading days outside
+the covered ranges raises.
+'''
+
+import os
+import posixpath
+import json
+import zlib
+
+import numpy as np
+
+from pulley.calendar import date_utils
+
+BAR_DTYPE = [('dt', 'M8[m]'),
+             ('op', 'f4'),
+             ('hi', 'f4'),
+             ('lo', 'f4'),
+             ('cl', 'f4'),
+             ('vol', 'f4')]
+
+INDEX_DTYPE = [('month', 'i4'),   # yyyymm
+               ('offset', 'i8'),  # byte offset of the chunk in <TKR>.bin
+               ('nbytes', 'i8'),  # compressed size
+               ('nrows', 'i8')]
+
+COMPRESS_LEVEL = 6
+
+def bin_path(pack_dir, tkr):
+    return posixpath.join(pack_dir, '%s.bin' % tkr.upper())
+
+def index_path(pack_dir, tkr):
+    return posixpath.join(pack_dir, '%s.idx.npy' % tkr.upper())
+
+def cover_path(pack_dir, tkr):
+    return posixpath.join(pack_dir, '%s.cover.json' % tkr.upper())
+
+'''
+Sorted, disjoint [iBeg, iEnd] day ranges packed for a ticker. Packs written
+before the ranges were recorded cover nothing.
+'''
+def read_cover(pack_dir, tkr):
+    sPath = cover_path(pack_dir, tkr)
+    if not os.path.isfile(sPath):
+        return []
+    with open(sPath, 'r') as f:
+        return [tuple(rng) for rng in json.load(f)]
+
+'''
+Add [iBeg, iEnd] to a list of day ranges, joining ranges that overlap or
+have no session between them.
+'''
+def add_range(ranges, iBeg, iEnd):
+    ranges = sorted(ranges + [(iBeg, iEnd)])
+    merged = [ranges[0]]
+    for iLo, iHi in ranges[1:]:
+        if iLo <= merged[-1][1] or date_utils.count_between(merged[-1][1] + 1, iLo - 1) == 0:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], iHi))
+        else:
+            merged.append((iLo, iHi))
+    return merged
+
+'''
+Returns true if the ticker's pack covers every session in [iBeg, iEnd].
+'''
+def covers(pack_dir, tkr, iBeg, iEnd):
+    if date_utils.count_between(iBeg, iEnd) == 0:
+        return os.path.isfile(index_path(pack_dir, tkr))
+    # first and last sessions of the request
+    iFirst = date_utils.next_session(iBeg - 1)
+    iLast = date_utils.offset(iEnd, 0)
+    for iLo, iHi in read_cover(pack_dir, tkr):
+        if iLo <= iFirst and iLast <= iHi:
+            return True
+    return False
+
+'''
+Returns true if pack_dir holds a pack for every ticker that covers [iBeg, iEnd].
+'''
+def has_pack(pack_dir, tickers, iBeg, iEnd):
+    if not pack_dir:
+        return False
+    for tkr in tickers:
+        if not covers(pack_dir, tkr, iBeg, iEnd):
+            return False
+    return True
+
+'''
+Compressed bytes of one chunk of a ticker's pack.
+'''
+def read_chunk(pack_dir, tkr, entry):
+    # reopen per chunk so that many concurrent streams don't hold file handles
+    with open(bin_path(pack_dir, tkr), 'rb') as f:
+        f.seek(entry['offset'])
+        return f.read(entry['nbytes'])
+
+def decompress_chunk(pack_dir, tkr, entry):
+    return np.frombuffer(zlib.decompress(read_chunk(pack_dir, tkr, entry)), dtype=BAR_DTYPE)
+
+'''
+yyyymm of datetime64 months.
+'''
+def yyyymm(viMonths):
+    return (1970 + viMonths // 12)*100 + viMonths % 12 + 1
+
+'''
+Write a ticker's time-sorted BAR_DTYPE records for the days [iBeg, iEnd] into
+its pack as one compressed chunk per month. Packed bars on those days are
+replaced and bars on other days are kept: months the range touches are
+rebuilt and the others copied over still compressed. Returns the number of
+bars in the pack.
+'''
+def write_pack(pack_dir, tkr, bars, iBeg, iEnd):
+    if not os.path.isdir(pack_dir):
+        os.makedirs(pack_dir)
+
+    old_index = np.zeros(0, dtype=INDEX_DTYPE)
+    if os.path.isfile(index_path(pack_dir, tkr)):
+        old_index = np.load(index_path(pack_dir, tkr))
+
+    vbRebuild = (old_index['month'] >= iBeg // 100) & (old_index['month'] <= iEnd // 100)
+    dBeg = date_utils.iDate2datetime64(iBeg)
+    dEnd = date_utils.iDate2datetime64(iEnd)
+    parts = [bars]
+    for entry in old_index[vbRebuild]:
+        old = decompress_chunk(pack_dir, tkr, entry)
+        vdDays = old['dt'].astype('datetime64[D]')
+        parts.append(old[(vdDays < dBeg) | (vdDays > dEnd)])
+    rebuilt = np.concatenate(parts)
+    rebuilt = rebuilt[np.argsort(rebuilt['dt'], kind='mergesort')]
+
+    # (yyyymm, nrows, compressed bytes) of every chunk of the new pack
+    chunks = [(entry['month'], entry['nrows'], read_chunk(pack_dir, tkr, entry))
+              for entry in old_index[~vbRebuild]]
+    viMonths = rebuilt['dt'].astype('datetime64[M]').astype(np.int64)
+    viBreaks = np.concatenate(([0], np.nonzero(np.diff(viMonths))[0] + 1, [rebuilt.shape[0]]))
+    for i in range(len(viBreaks) - 1):
+        if viBreaks[i] == viBreaks[i+1]:
+            continue
+        chunk = rebuilt[viBreaks[i]:viBreaks[i+1]]
+        chunks.append((yyyymm(viMonths[viBreaks[i]]), chunk.shape[0],
+                       zlib.compress(chunk.tobytes(), COMPRESS_LEVEL)))
+    chunks.sort(key=lambda chunk: chunk[0])
+
+    index = np.zeros(len(chunks), dtype=INDEX_DTYPE)
+    offset = 0
+    sTmp = bin_path(pack_dir, tkr) + '.tmp'
+    with open(sTmp, 'wb') as f:
+        for i, (iMonth, nrows, data) in enumerate(chunks):
+            f.write(data)
+            index[i] = iMonth, offset, len(data), nrows
+            offset += len(data)
+    os.rename(sTmp, bin_path(pack_dir, tkr))
+
+    sTmp = index_path(pack_dir, tkr) + '.tmp'
+    with open(sTmp, 'wb') as f:
+        np.save(f, index)
+    os.rename(sTmp, index_path(pack_dir, tkr))
+
+    # the covered ranges go last, so an interrupted repack claims no new days
+    sTmp = cover_path(pack_dir, tkr) + '.tmp'
+    with open(sTmp, 'w') as f:
+        json.dump(add_range(read_cover(pack_dir, tkr), iBeg, iEnd), f)
+    os.rename(sTmp, cover_path(pack_dir, tkr))
+    return int(index['nrows'].sum())
+
+'''
+Lazily yield a ticker's BAR_DTYPE records with dates in [iBeg, iEnd] (yyyymmdd)
+one monthly chunk at a time, decompressing only the chunks that overlap the range.
+Raises if the pack doesn't cover the range.
+'''
+def iter_pack(pack_dir, tkr, iBeg, iEnd):
+    if not covers(pack_dir, tkr, iBeg, iEnd):
+        raise Exception('QuantQuote pack for %s does not cover %i-%i (looking in %s)' % \
+                            (tkr, iBeg, iEnd, pack_dir))
+    index = np.load(index_path(pack_dir, tkr))
+    index = index[(index['month'] >= iBeg // 100) & (index['month'] <= iEnd // 100)]
+    dBeg = date_utils.iDate2datetime64(iBeg)
+    dEnd = date_utils.iDate2datetime64(iEnd)
+
+    for entry in index:
+        bars = decompress_chunk(pack_dir, tkr, entry)
+
+        # crop the first and last months to the requested days
+        vdDays = bars['dt'].astype('datetime64[D]')
+        yield bars[(vdDays >= dBeg) & (vdDays <= dEnd)]
+
+'''
+Read a ticker's BAR_DTYPE records with dates in [iBeg, iEnd] (yyyymmdd).
+'''
+def read_pack(pack_dir, tkr, iBeg, iEnd):
+    chunks = list(iter_pack(pack_dir, tkr, iBeg, iEnd))
+    if len(chunks) == 0:
+        return np.zeros(0, dtype=BAR_DTYPE)
+    return np.concatenate(chunks)
@@ -1,10 +1,19 @@
 import os
 import pytz
+import datetime
+import decimal
+import contextlib
 import numpy as np
 import pandas as pd
 import psycopg2
+import psycopg2.pool
 
+from pulley.calendar import date_utils
 from pulley.zp.sources.query_source import QuerySource
+from pulley.zp.sources.bar_cache import BarCache, BAR_DTYPE
+from pulley.zp.sources.benchmark import BenchmarkStore, simple_returns
+from pulley.zp.sources import bar_arrays
+from pulley.zp.sources.adjust import Adjuster
 
 from zipline.protocol import DATASOURCE_TYPE
 
@@ -13,9 +22,21 @@ redshift_user = os.getenv('AWS_REDSHIFT_USER', '')
 redshift_pwd = os.getenv('AWS_REDSHIFT_PWD', '')
 redshift_ip = os.getenv('AWS_REDSHIFT_IP', '')
 
+# local BarCache directory for get_data, disabled when empty
+redshift_cache_home = os.getenv('REDSHIFT_CACHE_HOME', '')
+
 EQUITY_BAR_TABLE = 'csi_adj'
 SQL_FORMAT = '%Y-%m-%d %H:%M:%S'
 PRINT_QUERIES = False
+FETCH_BATCH = 10000 # rows per fetchmany when streaming
+POOL_MIN = 1        # connections kept open by the pool
+POOL_MAX = 8        # maximum concurrent connections per process
+UNIVERSE_TABLE = 'pulley_universe' # session temp table of tickers
+UNIVERSE_BATCH = 1000              # tickers per INSERT when loading the universe
+
+_pool = None
+_pool_pid = None
+_bench_stores = {}
 
 '''
 Returns true if credentials are set and false otherwise.
@@ -29,20 +50,76 @@ def has_creds():
 Get a PostgreSQL connection to an AWS Redshift DB:
 '''
 def get_redshift_con():
-    return psycopg2.connect("dbname=db1 user=%s password=%s host=%s port=5439" % \
-                               (redshift_user, redshift_pwd, redshift_ip))
+    return psycopg2.connect(get_dsn())
+
+def get_dsn():
+    return "dbname=db1 user=%s password=%s host=%s port=5439" % (redshift_user, redshift_pwd, redshift_ip)
+
+'''
+Get the process-wide connection pool, creating it on first use. A forked
+child (e.g. a multiprocessing worker) gets its own pool instead of sharing
+the parent's sockets.
+'''
+def get_pool():
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        if not has_creds():
+            raise Exception('No environment variables set for AWS Redshift.')
+        _pool = psycopg2.pool.ThreadedConnectionPool(POOL_MIN, POOL_MAX, get_dsn())
+        _pool_pid = os.getpid()
+    return _pool
+
+'''
+Borrow a connection from the pool. Give it back with put_con.
+'''
+def get_con():
+    return get_pool().getconn()
+
+'''
+Return a borrowed connection to the pool, ending any open transaction.
+Broken connections are discarded.
+'''
+def put_con(con):
+    close = bool(con.closed)
+    if not close:
+        try:
+            con.rollback()
+        except psycopg2.Error:
+            close = True
+    get_pool().putconn(con, close=close)
+
+'''
+Context manager for a pooled connection:
+
+with pooled_con() as con:
+    cur = con.cursor()
+'''
+@contextlib.contextmanager
+def pooled_con():
+    con = get_con()
+    try:
+        yield con
+    finally:
+        put_con(con)
+
+PRICE_SCHEMA = {'dt': datetime.datetime, 'price': decimal.Decimal, 'volume': decimal.Decimal}
+MATCH_SCHEMA = {'dt': datetime.datetime, 'event_date': datetime.datetime}
 
 '''
 Get a Zipline DataSource generator with rows fetched from a Python DBAPI.
+fast=True uses the batched QuerySource path with a declared schema.
+rows_prices can also be column arrays, e.g. from bar_arrays.merge_columns.
 '''
-def get_price_events(rows_prices):    
-    return QuerySource(rows_prices, ['dt', 'sid', 'price', 'volume'], DATASOURCE_TYPE.TRADE)
+def get_price_events(rows_prices, fast=False):
+    return QuerySource(rows_prices, ['dt', 'sid', 'price', 'volume'], DATASOURCE_TYPE.TRADE,
+                       fast=fast, schema=PRICE_SCHEMA)
 
 '''
 Get a Zipline DataSource generator with rows fetched from a Python DB API.
 '''
-def get_match_events(rows_matches):
-    return QuerySource(rows_matches, ['dt', 'sid', 'event_date'], DATASOURCE_TYPE.CUSTOM)
+def get_match_events(rows_matches, fast=False):
+    return QuerySource(rows_matches, ['dt', 'sid', 'event_date'], DATASOURCE_TYPE.CUSTOM,
+                       fast=fast, schema=MATCH_SCHEMA)
 
 '''
 Execute a query, with optional printing of that query.
@@ -52,6 +129,136 @@ def cur_execute(cur, query):
         print query
     cur.execute(query)
 
+'''
+Get a named (server-side) cursor so that results stay on the server until fetched.
+Falls back to a plain cursor for DB-API stand-ins without named cursors.
+'''
+def get_server_cursor(con, name):
+    try:
+        return con.cursor(name)
+    except TypeError:
+        return con.cursor()
+
+'''
+Execute a query on a server-side cursor and lazily yield lists of up to
+batch_size rows. The cursor is closed, and release(con) called if given,
+once the generator is exhausted or discarded.
+'''
+def iter_batches(con, query, batch_size=FETCH_BATCH, name='pulley_stream', release=None):
+    cur = get_server_cursor(con, name)
+    try:
+        cur_execute(cur, query)
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        cur.close()
+        if release is not None:
+            release(con)
+
+'''
+Execute a query on a server-side cursor and lazily yield its rows, see iter_batches.
+'''
+def iter_query(con, query, batch_size=FETCH_BATCH, name='pulley_stream', release=None):
+    for rows in iter_batches(con, query, batch_size=batch_size, name=name, release=release):
+        for row in rows:
+            yield row
+
+'''
+Load tickers into the universe temp table (see load_universe) and lazily yield
+lists of rows of a query that selects from it, see iter_batches. Nothing is
+borrowed or sent until the first batch is asked for, and a pooled connection
+goes back to the pool once the generator is exhausted or closed, so a stream
+that is dropped unread holds no connection.
+'''
+def iter_universe_batches(tickers, query, con=None, batch_size=FETCH_BATCH, name='pulley_stream'):
+    release = None
+    if con is None:
+        con = get_con()
+        release = put_con
+    batches = None
+    try:
+        cur = con.cursor()
+        load_universe(cur, tickers)
+        cur.close()
+        batches = iter_batches(con, query, batch_size=batch_size, name=name)
+        for rows in batches:
+            yield rows
+    finally:
+        if batches is not None:
+            batches.close()
+        if release is not None:
+            release(con)
+
+'''
+Convert (obs_date, symu, openu, lastu, volume) rows into arrays:
+integer yyyymmdd dates, a list of symbols and float open, close and volume.
+'''
+def daily_rows_to_arrays(rows):
+    viDates = np.array([row[0].year*10000 + row[0].month*100 + row[0].day for row in rows], dtype=np.int64)
+    vsSyms = [row[1] for row in rows]
+    vnOpen = np.array([float(row[2]) for row in rows])
+    vnClose = np.array([float(row[3]) for row in rows])
+    vnVolume = np.array([float(row[4]) for row in rows])
+    return viDates, vsSyms, vnOpen, vnClose, vnVolume
+
+'''
+Expand (obs_date, symu, openu, lastu, volume) rows ordered by (obs_date, symu)
+into (dt, sid, price, volume) rows at 09:30 and 16:00, ordered by (dt, sid).
+A stable sort on dt keeps the server's symbol order within each time.
+'''
+def expand_daily_rows(rows):
+    if len(rows) == 0:
+        return []
+    viDates, vsSyms, vnOpen, vnClose, vnVolume = daily_rows_to_arrays(rows)
+    vdDates = date_utils.iDate2datetime64(viDates).astype('datetime64[m]')
+
+    vdt = np.concatenate([vdDates + bar_arrays.OPEN_OFFSET, vdDates + bar_arrays.CLOSE_OFFSET])
+    vnPrice = np.concatenate([vnOpen, vnClose])
+    vnVolume = np.concatenate([vnVolume, vnVolume])
+    vsSids = vsSyms + vsSyms
+
+    idx = np.argsort(vdt, kind='mergesort')
+    return zip(vdt[idx].astype('datetime64[us]').tolist(),
+               [vsSids[i] for i in idx.tolist()],
+               vnPrice[idx].tolist(),
+               vnVolume[idx].tolist())
+
+'''
+Lazily expand batches of daily rows (see expand_daily_rows). The last day
+of each batch is held back until the next batch, since its remaining
+symbols' opens must come out before its closes.
+'''
+def iter_daily_events(batches):
+    carry = []
+    for rows in batches:
+        rows = carry + list(rows)
+        iSplit = len(rows)
+        while iSplit > 0 and rows[iSplit-1][0] == rows[-1][0]:
+            iSplit -= 1
+        carry = rows[iSplit:]
+        for event in expand_daily_rows(rows[:iSplit]):
+            yield event
+    for event in expand_daily_rows(carry):
+        yield event
+
+'''
+Load tickers into a session temp table for use in 'symu IN (SELECT sym FROM ...)'.
+Temp tables are private to the connection, so concurrent backtests can't
+clobber each other, and the tickers are sent in multi-row INSERT batches
+rather than as one SELECT per ticker.
+'''
+def load_universe(cur, tickers, table=UNIVERSE_TABLE):
+    cur_execute(cur, 'DROP TABLE IF EXISTS %s' % table)
+    cur_execute(cur, 'CREATE TEMP TABLE %s (sym VARCHAR(30))' % table)
+    tickers = sorted(set(tickers))
+    for i in range(0, len(tickers), UNIVERSE_BATCH):
+        values = ','.join(cur.mogrify('(%s)', (tkr,)) for tkr in tickers[i:i+UNIVERSE_BATCH])
+        cur_execute(cur, 'INSERT INTO %s VALUES %s' % (table, values))
+    return table
+
 '''
 Check if a PostgreSQL cursor has a table called table_name.
 '''
@@ -60,17 +267,105 @@ def is_table(cur, table_name):
     return bool(cur.rowcount)
 
 '''
-Get data to run an algo. Used in pulley.trading exclusively.
+Name of the bar table for adjusted or unadjusted prices.
 '''
-def get_data(tickers, tBeg, tEnd, adjusted=True):
+def get_bar_table(adjusted):
+    if adjusted:
+        return 'csi_adj'
+    return 'csi_unadj'
 
-    if not has_creds():
-        raise Exception('No environment variables set for AWS Redshift.')
+'''
+Fetch one row per symbol and day with dates in [iBeg, iEnd] (yyyymmdd).
+Returns a dict of symbol -> bar_cache.BAR_DTYPE array sorted by date,
+so it can be used as the fetch function of a BarCache.
+'''
+def fetch_daily(tickers, iBeg, iEnd, adjusted=True, con=None):
+
+    query = """\
+SELECT obs_date, symu, openu, lastu, volu*100.0
+FROM %(BAR_TABLE)s
+WHERE symu in (SELECT sym from %(UNI_TABLE)s)
+AND obs_date >= '%(T_BEG)s'
+AND obs_date <= '%(T_END)s'
+ORDER BY symu, obs_date
+"""
+
+    if con is None:
+        with pooled_con() as con:
+            return fetch_daily(tickers, iBeg, iEnd, adjusted=adjusted, con=con)
 
-    con = get_redshift_con()
     cur = con.cursor()
-    
-    event_table = 'event_table' # table to copy the query results into
+    query = query % {'BAR_TABLE': get_bar_table(adjusted),
+                     'UNI_TABLE': load_universe(cur, tickers),
+                     'T_BEG': date_utils.iDate2Datetime(iBeg).strftime(SQL_FORMAT),
+                     'T_END': date_utils.iDate2Datetime(iEnd).strftime(SQL_FORMAT)}
+    cur_execute(cur, query)
+    rows = cur.fetchall()
+    cur.close()
+
+    out = {}
+    if len(rows) == 0:
+        return out
+
+    bars = np.empty(len(rows), dtype=BAR_DTYPE)
+    bars['date'], vsSyms, bars['op'], bars['cl'], bars['vol'] = daily_rows_to_arrays(rows)
+
+    iLo = 0
+    for i in range(1, len(rows) + 1):
+        if i == len(rows) or vsSyms[i] != vsSyms[iLo]:
+            out[vsSyms[iLo]] = bars[iLo:i]
+            iLo = i
+    return out
+
+'''
+Get price rows from the daily bars in a local BarCache, querying Redshift
+only for the dates the cache doesn't cover yet.
+With local_adjust=True adjusted bars are computed from the cached unadjusted
+bars and the $SPLIT_FILE/$DIV_FILE tables (see adjust.Adjuster), so only the
+unadjusted table is fetched and stored.
+'''
+def get_cached_data(tickers, tBeg, tEnd, adjusted=True, stream=False, cache_dir=redshift_cache_home,
+                    local_adjust=False):
+
+    iBeg = date_utils.datetime2iDate(tBeg)
+    iEnd = date_utils.datetime2iDate(tEnd)
+    if adjusted and local_adjust:
+        adjuster = Adjuster()
+        bars = BarCache(cache_dir).get(tickers, iBeg, iEnd, False, fetch_daily)
+        bars = dict((tkr, adjuster.adjust(tkr, bars[tkr])) for tkr in tickers)
+    else:
+        bars = BarCache(cache_dir).get(tickers, iBeg, iEnd, adjusted, fetch_daily)
+
+    parts = []
+    for tkr in tickers:
+        vdDates = date_utils.iDate2datetime64(bars[tkr]['date'])
+        parts.append((tkr,) + bar_arrays.daily_events(vdDates, bars[tkr]['op'], bars[tkr]['cl'], bars[tkr]['vol']))
+
+    if stream:
+        return bar_arrays.iter_merge([(part[0], [part[1:]]) for part in parts])
+    return bar_arrays.merge(parts)
+
+'''
+Get data to run an algo. Used in pulley.trading exclusively.
+With stream=True the rows are returned as a generator fed from a server-side
+cursor in batches of batch_size, so memory stays bounded and the transfer
+overlaps with the simulation. Connections come from the pool unless a
+DB-API connection is passed in as con, in which case it is left open.
+When cache_dir is set (default $REDSHIFT_CACHE_HOME) the bars are served
+from a local BarCache instead, see get_cached_data (and local_adjust).
+With single_scan=True each (obs_date, symu) row is fetched once and expanded
+into its open and close events on the client, which halves the scan, the
+server-side sort and the bytes transferred compared to the UNION ALL query.
+'''
+def get_data(tickers, tBeg, tEnd, adjusted=True, stream=False, batch_size=FETCH_BATCH, con=None,
+             cache_dir=redshift_cache_home, single_scan=False, local_adjust=False):
+
+    if cache_dir:
+        return get_cached_data(tickers, tBeg, tEnd, adjusted=adjusted, stream=stream, cache_dir=cache_dir,
+                               local_adjust=local_adjust)
+    if local_adjust:
+        raise Exception('local_adjust needs a bar cache, set cache_dir or $REDSHIFT_CACHE_HOME')
+
     eastern = pytz.timezone('US/Eastern')
     
     sBeg = tBeg.strftime(SQL_FORMAT)            # for use with yyyy-mm-dd HH-MM-SS' format (DeltaNeutral)
@@ -78,30 +373,8 @@ def get_data(tickers, tBeg, tEnd, adjusted=True):
     sBegDate = tBeg.date().strftime(SQL_FORMAT) # for use with 'yyyy-mm-dd 00:00:00' format (CSI)
     sEndDate = tEnd.date().strftime(SQL_FORMAT) #
 
-    # check if event_table already exists
-    if is_table(cur, event_table):
-        query_drop = "DROP TABLE %s" % event_table
-        cur_execute(cur, query_drop)
-
-    ## Make a table for tickers
-    query = 'SELECT * INTO %s FROM (\n' % event_table 
-    for i, tkr in enumerate(tickers):
-        if i == 0:
-            query += "SELECT '%s' as event_sym" % tkr
-        else:
-            query += "SELECT '%s'" % tkr
-        if i != len(tickers) - 1:
-            query += ' UNION ALL\n'            
-    query += ')'
+    bar_table = get_bar_table(adjusted)
 
-    cur_execute(cur, query)
-    con.commit()
-
-    if adjusted:
-        bar_table = 'csi_adj'
-    else:
-        bar_table = 'csi_unadj'
-    
     ##
     ## Equity quote data (open and close prices with corresponding times)
     ##
@@ -112,7 +385,7 @@ def get_data(tickers, tBeg, tEnd, adjusted=True):
 SELECT * FROM (
     SELECT obs_date+interval '16 hour' as dt, symu as sid, lastu as price, volu*100.0 as volume
     FROM %(BAR_TABLE)s
-    WHERE symu in (SELECT DISTINCT event_sym from %(UNI_TABLE)s)
+    WHERE symu in (SELECT sym from %(UNI_TABLE)s)
     AND obs_date >= '%(T_BEG)s'
     AND obs_date <= '%(T_END)s'
 
@@ -120,33 +393,72 @@ SELECT * FROM (
 
     SELECT obs_date+interval '9 hour'+interval '30 minutes' as dt, symu as sid, openu as price, volu*100.0 as volume
     FROM %(BAR_TABLE)s
-    WHERE symu in (SELECT DISTINCT event_sym from %(UNI_TABLE)s)
+    WHERE symu in (SELECT sym from %(UNI_TABLE)s)
     AND obs_date >= '%(T_BEG)s'
     AND obs_date <= '%(T_END)s' 
 )
 ORDER BY dt, sid
 """
+    if single_scan:
+        query = """\
+SELECT obs_date, symu, openu, lastu, volu*100.0
+FROM %(BAR_TABLE)s
+WHERE symu in (SELECT sym from %(UNI_TABLE)s)
+AND obs_date >= '%(T_BEG)s'
+AND obs_date <= '%(T_END)s'
+ORDER BY obs_date, symu
+"""
+
     query = query % {'BAR_TABLE': bar_table ,
-                     'UNI_TABLE': event_table,
+                     'UNI_TABLE': UNIVERSE_TABLE,
                      'T_BEG': sBegDate,
                      'T_END': sEndDate}
-    
-    cur_execute(cur, query)
-    rows_prices = cur.fetchall()
-
-    cur.close()
-    con.close()
 
+    if stream and single_scan:
+        return iter_daily_events(iter_universe_batches(tickers, query, con=con, batch_size=batch_size,
+                                                       name='pulley_prices'))
+
+    if stream:
+        return (row for rows in iter_universe_batches(tickers, query, con=con, batch_size=batch_size,
+                                                      name='pulley_prices')
+                for row in rows)
+
+    release = None
+    if con is None:
+        con = get_con()
+        release = put_con
+    try:
+        cur = con.cursor()
+        load_universe(cur, tickers)
+        cur_execute(cur, query)
+        rows_prices = cur.fetchall()
+        cur.close()
+    finally:
+        if release is not None:
+            release(con)
+
+    if single_scan:
+        return expand_daily_rows(rows_prices)
     return rows_prices
 
+'''
+Get the process-wide BenchmarkStore for a cache directory.
+'''
+def get_bench_store(cache_dir=redshift_cache_home):
+    if cache_dir not in _bench_stores:
+        _bench_stores[cache_dir] = BenchmarkStore(cache_dir, fetch_daily)
+    return _bench_stores[cache_dir]
+
 '''
 <TODO> Check for usages (I think it's not used anywhere)
+When cache_dir is set (default $REDSHIFT_CACHE_HOME) the SPY closes come from
+the local BenchmarkStore and only new days are queried.
 '''
-def get_bench_source(tBeg, tEnd):
+def get_bench_source(tBeg, tEnd, cache_dir=redshift_cache_home):
+
+    if cache_dir:
+        return get_bench_store(cache_dir).source(tBeg, tEnd)
 
-    con = get_redshift_con()
-    cur = con.cursor()
-    
     eastern = pytz.timezone('US/Eastern')
     
     sBeg = tBeg.strftime(SQL_FORMAT)            # for use with yyyy-mm-dd HH-MM-SS' format (DeltaNeutral)
@@ -163,30 +475,33 @@ def get_bench_source(tBeg, tEnd):
     ORDER BY dt
     """ % (EQUITY_BAR_TABLE, sBegDate, sEndDate)
 
-    cur_execute(cur, query)
-    rows = cur.fetchall()
+    with pooled_con() as con:
+        cur = con.cursor()
+        cur_execute(cur, query)
+        rows = cur.fetchall()
+        cur.close()
 
     bench_price_utc = pd.Series([float(row[1]) for row in rows],
                             index=[eastern.localize(row[0]).astimezone(pytz.utc) for row in rows])
 
-    bench_source = []
-    for i, index in enumerate(bench_price_utc.index):
-        bench_source.append({'dt': index,
-                             'returns': bench_price_utc[i]/bench_price_utc[i-1] - 1.0,
-                             'type': DATASOURCE_TYPE.BENCHMARK,
-                             'source_id': 'ga_benchmark'})
-    cur.close()
-    con.close()
+    # the first day has no previous close in the window, so its return is 0.0
+    vnReturns = simple_returns(bench_price_utc.values)
+    bench_source = [{'dt': index,
+                     'returns': ret,
+                     'type': DATASOURCE_TYPE.BENCHMARK,
+                     'source_id': 'ga_benchmark'}
+                    for index, ret in zip(bench_price_utc.index, vnReturns.tolist())]
 
     return bench_source, bench_price_utc
 
 '''
-Replacement for Zipline's Yahoo dependency. Fetches SPY returns from database.
+Replacement for Zipline's Yahoo dependency. Fetches SPY returns from database,
+or from the local BenchmarkStore when cache_dir is set.
 '''
-def get_bench_returns():
-    
-    con = get_redshift_con()
-    cur = con.cursor()
+def get_bench_returns(cache_dir=redshift_cache_home):
+
+    if cache_dir:
+        return get_bench_store(cache_dir).returns()
 
     query = """\
     SELECT obs_date as dt, lastu
@@ -195,8 +510,11 @@ def get_bench_returns():
     ORDER BY dt
     """ % (EQUITY_BAR_TABLE)
 
-    cur_execute(cur, query)
-    data = cur.fetchall()
+    with pooled_con() as con:
+        cur = con.cursor()
+        cur_execute(cur, query)
+        data = cur.fetchall()
+        cur.close()
     dates = [datum[0] for datum in data]
     del dates[0]
     prices = np.array([float(datum[1]) for datum in data])
@@ -205,7 +523,4 @@ def get_bench_returns():
     benchmark_returns = pd.Series(prices[1:]/prices[:-1] - 1.0, index=dates)
     benchmark_returns = benchmark_returns.tz_localize('UTC')
 
-    cur.close()
-    con.close()
-
     return benchmark_returns
@@ -1,8 +1,18 @@
 """
 Splits and dividend utils for Zipline.
+
+The CSV files are
+    splits:    SYMBOL,yyyymmdd,NUM,DEN,RATIO
+    dividends: SYMBOL,yyyymmdd,AMOUNT
+and are parsed once into a date-sorted ColumnStore indexed by symbol
+(<fname>.store), which is rebuilt whenever the CSV is newer than it. The
+sources and loaders read only the requested tickers and [iBeg, iEnd] window.
 """
 
-from datetime import datetime, timedelta
+import os
+import posixpath
+from datetime import timedelta
+import numpy as np
 import pytz
 import pandas as pd
 
@@ -12,14 +22,110 @@ from zipline.protocol import DATASOURCE_TYPE
 from zipline.utils.factory import create_split
 from zipline.utils.factory import create_dividend
 
+from pulley.calendar import date_utils
+from pulley.zp.sources.column_store import ColumnStore, ColumnStoreWriter, is_store, META_FILE
+
+SPLIT_COLS = ['symbol', 'date', 'num', 'den', 'ratio']
+SPLIT_DTYPE = [('date', 'i8'),
+               ('num', 'f8'),
+               ('den', 'f8'),
+               ('ratio', 'f8')]
+
+DIV_COLS = ['symbol', 'date', 'amount']
+DIV_DTYPE = [('date', 'i8'),
+             ('amount', 'f8')]
+
+'''
+Directory of the binary table built from a split or dividend CSV.
+'''
+def table_path(fname):
+    return fname + '.store'
+
+'''
+Parse a split or dividend CSV into a ColumnStore at table_path(fname).
+'''
+def build_table(fname, names, dtypes):
+    frame = pd.read_csv(fname, header=None, names=names, dtype={'symbol': str})
+    frame['symbol'] = frame['symbol'].str.strip()
+
+    writer = ColumnStoreWriter(table_path(fname), dtypes)
+    for symbol, group in frame.groupby('symbol', sort=True):
+        writer.append(symbol, dict((name, group[name].values) for name, _ in dtypes))
+    writer.close()
+    return table_path(fname)
+
+'''
+Open the table for a CSV, (re)building it first if it is missing or older than the CSV.
+'''
+def get_table(fname, names, dtypes):
+    sStore = table_path(fname)
+    if not is_store(sStore) or \
+       os.path.getmtime(posixpath.join(sStore, META_FILE)) < os.path.getmtime(fname):
+        build_table(fname, names, dtypes)
+    return ColumnStore(sStore)
+
+def get_split_table(fname):
+    return get_table(fname, SPLIT_COLS, SPLIT_DTYPE)
+
+def get_div_table(fname):
+    return get_table(fname, DIV_COLS, DIV_DTYPE)
 
+'''
+Rows of a split or dividend table for tickers (default all) with dates in
+[iBeg, iEnd], as (vsSymbols, columns) sorted by date. Tickers missing from
+the table have no events and are skipped.
+'''
+def select(table, tickers=None, iBeg=None, iEnd=None):
+    if tickers is None:
+        tickers = [str(sym) for sym in table.symbols]
+
+    vsSymbols = []
+    parts = []
+    for tkr in tickers:
+        if tkr not in table:
+            continue
+        cols = table.get(tkr, iBeg, iEnd)
+        vsSymbols.append(np.repeat(np.array([tkr], dtype=object), cols['date'].shape[0]))
+        parts.append(cols)
+
+    names = list(table.columns.keys())
+    if len(parts) == 0:
+        return np.zeros(0, dtype=object), dict((name, table.columns[name][:0]) for name in names)
+
+    vsSymbols = np.concatenate(vsSymbols)
+    columns = dict((name, np.concatenate([part[name] for part in parts])) for name in names)
+    idx = np.argsort(columns['date'], kind='mergesort')
+    return vsSymbols[idx], dict((name, col[idx]) for name, col in columns.items())
+
+'''
+UTC midnight datetimes of integer yyyymmdd dates.
+'''
+def utc_days(viDates):
+    index = pd.DatetimeIndex(date_utils.iDate2datetime64(viDates)).tz_localize(pytz.utc)
+    return index.to_pydatetime().tolist()
+
+'''
+Integer yyyymmdd of an optional datetime bound.
+'''
+def iDate_or_none(t):
+    if t is None:
+        return None
+    return date_utils.datetime2iDate(t)
+
+
+'''
+Split events for tickers (default all) with dates in [tBeg, tEnd].
+'''
 class CsvSplitSource(DataSource):
 
     sids = []
     
-    def __init__(self, fname):
+    def __init__(self, fname, tickers=None, tBeg=None, tEnd=None):
         self.fname = fname
-        self.arg_string = hash_args(fname)
+        self.tickers = tickers
+        self.tBeg = tBeg
+        self.tEnd = tEnd
+        self.arg_string = hash_args(fname, tickers, tBeg, tEnd)
         self._raw_data = None
         
     @property
@@ -33,19 +139,17 @@ class CsvSplitSource(DataSource):
         return self.arg_string
 
     def raw_data_gen(self):
-        with open(self.fname, 'r') as f:
-            for line in f:
-                toks = line.split(',')
-                '''
-                Note:
-                In create_split(sid, ratio, dt), the input dt is zeroed out to the day, ie)
-                    dt.replace(hour=0, minute=0, second=0, microsecond=0).    
-                <TODO> When exactly do these split events get fired, on open or on close?
-                '''
-                event = create_split(toks[0],
-                                     float(toks[-1].replace('\n','')),
-                                     pytz.utc.localize(datetime.strptime(str(toks[1]), '%Y%m%d')))
-                yield event
+        vsSymbols, cols = select(get_split_table(self.fname), self.tickers,
+                                 iDate_or_none(self.tBeg), iDate_or_none(self.tEnd))
+        for sid, ratio, dt in zip(vsSymbols.tolist(), cols['ratio'].tolist(), utc_days(cols['date'])):
+            '''
+            Note:
+            In create_split(sid, ratio, dt), the input dt is zeroed out to the day, ie)
+                dt.replace(hour=0, minute=0, second=0, microsecond=0).    
+            <TODO> When exactly do these split events get fired, on open or on close?
+            '''
+            event = create_split(sid, ratio, dt)
+            yield event
 
     @property
     def raw_data(self):
@@ -59,15 +163,21 @@ class CsvSplitSource(DataSource):
 
 
 
+'''
+Dividend events for tickers (default all) with dates in [tBeg, tEnd].
+'''
 class CsvDividendSource(DataSource):
 
     sids = []
     
-    def __init__(self, fname):
+    def __init__(self, fname, tickers=None, tBeg=None, tEnd=None):
         self.fname = fname
+        self.tickers = tickers
+        self.tBeg = tBeg
+        self.tEnd = tEnd
         
         # Hash_value for downstream sorting.
-        self.arg_string = hash_args(fname)
+        self.arg_string = hash_args(fname, tickers, tBeg, tEnd)
 
         self._raw_data = None
         
@@ -87,21 +197,17 @@ class CsvDividendSource(DataSource):
         return self.arg_string
 
     def raw_data_gen(self):
-        with open(self.fname, 'r') as f:
-            for line in f:
-                toks = line.split(',')
-                sid = toks[0]
-                tDay = pytz.utc.localize(datetime.strptime(str(toks[1]), '%Y%m%d'))
-                nAmt = float(toks[2].replace('\n',''))
-
-                # Set ex_date to the data's datetime.
-                # Move the declared date arbitrarily one day back from ex_date.
-                # Move the payment date arbitrarily one day forward from ex_date.
-                ex_date = tDay
-                declared_date = ex_date - timedelta(days=1)
-                pay_date = ex_date + timedelta(days=1)
-                event = create_dividend(sid, nAmt, tDay, tDay, tDay)
-                yield event
+        vsSymbols, cols = select(get_div_table(self.fname), self.tickers,
+                                 iDate_or_none(self.tBeg), iDate_or_none(self.tEnd))
+        for sid, nAmt, tDay in zip(vsSymbols.tolist(), cols['amount'].tolist(), utc_days(cols['date'])):
+            # Set ex_date to the data's datetime.
+            # Move the declared date arbitrarily one day back from ex_date.
+            # Move the payment date arbitrarily one day forward from ex_date.
+            ex_date = tDay
+            declared_date = ex_date - timedelta(days=1)
+            pay_date = ex_date + timedelta(days=1)
+            event = create_dividend(sid, nAmt, tDay, tDay, tDay)
+            yield event
 
     @property
     def raw_data(self):
@@ -117,28 +223,15 @@ class CsvDividendSource(DataSource):
 Output:
 [['EEM', 20050609, 3.0, 1.0, 3.0],...]
 '''
-def load_split_csv(fname):
-    splits = []
-    with open(fname, 'r') as f:
-        for line in f:
-            toks = line.split(',')
-            splits.append([toks[0], int(toks[1]),
-                           float(toks[2]), float(toks[3]),
-                           float(toks[4])])
-    # sort by date
-    splits.sort(key=lambda x: float(x[1]))
-    return splits
+def load_split_csv(fname, tickers=None, iBeg=None, iEnd=None):
+    vsSymbols, cols = select(get_split_table(fname), tickers, iBeg, iEnd)
+    return [list(row) for row in zip(vsSymbols.tolist(), cols['date'].tolist(), cols['num'].tolist(),
+                                     cols['den'].tolist(), cols['ratio'].tolist())]
 
 '''
 Output:
 [['TLT', 20080701, 0.332],...]
 '''
-def load_div_csv(fname):
-    divs = []
-    with open(fname, 'r') as f:
-        for line in f:
-            toks = line.split(',')
-            divs.append([toks[0], int(toks[1]), float(toks[2])])
-    # sort by date
-    divs.sort(key=lambda x: float(x[1]))
-    return divs
+def load_div_csv(fname, tickers=None, iBeg=None, iEnd=None):
+    vsSymbols, cols = select(get_div_table(fname), tickers, iBeg, iEnd)
+    return [list(row) for row in zip(vsSymbols.tolist(), cols['date'].tolist(), cols['amount'].tolist())]
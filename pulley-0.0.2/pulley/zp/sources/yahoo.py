@@ -1,25 +1,111 @@
+import os
+import posixpath
+import hashlib
+
+import numpy as np
+import pandas as pd
 
 from zipline.utils.factory import load_bars_from_yahoo
 
+from pulley.calendar import date_utils
+from pulley.zp.sources import bar_arrays
+
+yahoo_cache_home = os.getenv('YAHOO_CACHE_HOME', '')
+yahoo_offline = os.getenv('YAHOO_OFFLINE', '') not in ('', '0')
+
+'''
+Pickle file of a cached panel, keyed by (tickers, date range, adjusted).
+Long universes are hashed to keep the file name short.
+'''
+def cache_path(cache_dir, tickers, tBeg, tEnd, adjusted):
+    sTkrs = ','.join(sorted(tickers))
+    if len(sTkrs) > 40:
+        sTkrs = hashlib.md5(sTkrs).hexdigest()
+    sName = '%s_%i_%i_%s.pkl' % (sTkrs, date_utils.datetime2iDate(tBeg), date_utils.datetime2iDate(tEnd),
+                                 'adj' if adjusted else 'unadj')
+    return posixpath.join(cache_dir, sName)
+
 '''
 Fetch a Pandas DataPanel of Yahoo finance historical bar data.
+With cache_dir set (default $YAHOO_CACHE_HOME) fetched panels are pickled
+there and replayed by later calls for the same request. With offline=True
+(default set by $YAHOO_OFFLINE) the network is never used, so a request
+that isn't cached raises.
 '''
-def fetch(tickers, tBeg, tEnd, adjusted=False):
-    return load_bars_from_yahoo(stocks=tickers, indexes={}, start=tBeg, end=tEnd, adjusted=adjusted)
+def fetch(tickers, tBeg, tEnd, adjusted=False, cache_dir=yahoo_cache_home, offline=yahoo_offline):
+    sPath = cache_path(cache_dir, tickers, tBeg, tEnd, adjusted) if cache_dir else None
+    if sPath is not None and os.path.isfile(sPath):
+        return pd.read_pickle(sPath)
+    if offline:
+        raise Exception('Yahoo bars are not cached for offline mode: %s' % (sPath or 'no cache_dir set'))
+
+    panel = load_bars_from_yahoo(stocks=tickers, indexes={}, start=tBeg, end=tEnd, adjusted=adjusted)
+
+    if sPath is not None:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        panel.to_pickle(sPath + '.tmp')
+        os.rename(sPath + '.tmp', sPath)
+    return panel
 
 '''
 Convert a Zipline Yahoo fetch into a flat list of date-sorted tuples.
 '''
 def flatten_panel(panel, include_open=True):
-    rows_prices = []
-    for t_utc in panel.major_axis:
-        dt = t_utc.to_datetime().replace(hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
-        if include_open:
-            for tkr in panel.items:
-                bar = panel.ix[tkr, t_utc]
-                rows_prices.append([dt.replace(hour=9, minute=30), tkr, bar['open'], bar['volume']])
-        for tkr in panel.items:
-            bar = panel.ix[tkr, t_utc]                
-            rows_prices.append([dt.replace(hour=16, minute=0), tkr, bar['close'], bar['volume']])
-    return rows_prices
+    columns = panel_columns(panel, include_open=include_open)
+    return [list(row) for row in zip(columns['dt'].tolist(), columns['sid'].tolist(),
+                                     columns['price'].tolist(), columns['volume'].tolist())]
+
+'''
+Per-ticker (tkr, vdt, vnPrice, vnVolume) event arrays of a Yahoo panel.
+'''
+def panel_parts(panel, include_open=True):
+    index = panel.major_axis
+    if index.tz is not None:
+        index = index.tz_convert('UTC').tz_localize(None)
+    vdDates = index.normalize().values.astype('datetime64[D]')
+
+    parts = []
+    for tkr in panel.items:
+        frame = panel[tkr]
+        parts.append((tkr,) + bar_arrays.daily_events(vdDates, frame['open'].values, frame['close'].values,
+                                                      frame['volume'].values, include_open=include_open))
+    return parts
+
+'''
+Generator version of flatten_panel that merges the tickers lazily in
+(dt, sid) order from per-ticker arrays.
+'''
+def iter_panel(panel, include_open=True):
+    return bar_arrays.iter_merge([(part[0], [part[1:]]) for part in panel_parts(panel, include_open)])
+
+'''
+Column-array version of flatten_panel for QuerySource. The open and close
+fields are stacked as (date, open/close, ticker) matrices for all tickers at
+once, so rows come out in the same order as flatten_panel always used: each
+day's opens for all tickers, then its closes.
+'''
+def panel_columns(panel, include_open=True):
+    index = panel.major_axis
+    if index.tz is not None:
+        index = index.tz_convert('UTC').tz_localize(None)
+    vdDates = index.normalize().values.astype('datetime64[D]').astype('datetime64[m]')
+    vsTkrs = np.array(list(panel.items), dtype=object)
+    iD, iT = len(vdDates), len(vsTkrs)
+
+    mnVolume = panel.minor_xs('volume').values
+    if include_open:
+        vdOffsets = np.array([bar_arrays.OPEN_OFFSET, bar_arrays.CLOSE_OFFSET])
+        mnPrice = np.stack([panel.minor_xs('open').values, panel.minor_xs('close').values], axis=1)
+        mnVolume = np.stack([mnVolume, mnVolume], axis=1)
+    else:
+        vdOffsets = np.array([bar_arrays.CLOSE_OFFSET])
+        mnPrice = panel.minor_xs('close').values[:, np.newaxis, :]
+        mnVolume = mnVolume[:, np.newaxis, :]
+    iK = len(vdOffsets)
 
+    vdt = (vdDates[:, np.newaxis] + vdOffsets[np.newaxis, :]).astype('datetime64[us]')
+    return {'dt': np.repeat(vdt.ravel(), iT),
+            'sid': np.tile(vsTkrs, iD*iK),
+            'price': mnPrice.ravel(),
+            'volume': mnVolume.ravel()}